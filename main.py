@@ -1,53 +1,62 @@
 from __future__ import print_function, annotations
 
 import asyncio
+import contextvars
 import datetime
+import heapq
+import inspect
+import itertools
 import json
 import math
 import os.path
+import signal
+import sys
+import threading
 import time
 import traceback
 import pytz
 from asyncio import Task
-from typing import Dict, List, Any
-from functools import wraps
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Any, Awaitable, Callable, Iterable, Iterator
+from functools import wraps, cached_property
 
 import emoji
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
 import pandas as pd
 from pandas import DataFrame
 
 from telegram.ext import MessageHandler, CallbackContext, CommandHandler, \
-    CallbackQueryHandler, ApplicationBuilder, Application, filters
+    CallbackQueryHandler, ApplicationBuilder, Application, BaseRateLimiter, BaseUpdateProcessor, filters
+from telegram.error import RetryAfter
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, \
-    InlineKeyboardButton, Bot, ForceReply, ChatMember
+    InlineKeyboardButton, Bot, ForceReply, ChatMember, Message
 import telegram.helpers
 
 import logging
+import logging.handlers
 
-from telethon.errors import UserPrivacyRestrictedError
-from telethon.sync import TelegramClient
-from telethon.tl.functions.channels import InviteToChannelRequest
-from telethon.tl.functions.messages import ExportChatInviteRequest
+# Google API and Telethon modules are slow to import and are not needed for the first replies,
+# they are imported on first use
 
 from assistant import HelpAssistant, is_bot_assistant_request
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-TABLES_SYNC_TASK: None or Task = None
-CACHES_STALE_TASK: None or Task = None
-ACTIONS_QUEUE_TASK: None or Task = None
-USERS_CONTEXT_SAVE_TASK: None or Task = None
-SCHEDULED_TASKS_EXECUTION_TASK: None or Task = None
 GOOGLE_CREDENTIALS = None
 TG_BOT_APPLICATION: Application
 TG_BOT: Bot
-TG_CLIENT: TelegramClient
+TG_CLIENT: TelegramClient or None = None
+TG_CLIENT_LOCK = asyncio.Lock()
+TG_RATE_LIMITER: TelegramRateLimiter
+TG_UPDATE_PROCESSOR: OrderedUpdateProcessor
+METRICS_SERVER: asyncio.Server or None = None
 
 CONFIGS = {
     "buildings": {},
@@ -58,8 +67,15 @@ STATS = {}
 
 DB = {}
 PARKING_CLEANING_DB = {}
+PARKING_CLEANING_ROSTER = {}
+BUILDINGS_DIRECTORY = {}
+RESIDENTS_VIEWS = {}
 
 QUEUED_ACTIONS = []
+TG_DELETE_MESSAGES_BATCH_SIZE = 100
+TG_MESSAGE_MAX_LENGTH = 4096
+# only updates with handlers in setup_command_handlers(), MessageHandler also handles edited messages
+TG_ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY]
 
 DF_COLUMNS = [
     'property_id',
@@ -113,11 +129,23 @@ GROUPS_IDS_EMOJI = {
 }
 
 TABLES_RELOADED_TIME = 0
+TABLES_GENERATION = 0
+# building -> value of TABLES_GENERATION at the last change of its tables
+TABLES_GENERATIONS: Dict[str, int] = {}
+TABLES_SOURCES = {}
 LAST_STALED_USER_CACHE = time.time()
 QUEUED_ACTIONS_LAST_EXECUTED_TIME = time.time()
-LAST_PARKING_CLEANING_NOTIFICATION_DATE = None
+
+CALENDAR_JOBS_FILEPATH = './data/calendar_jobs.json'
+ACTIONS_QUEUE_FILEPATH = './data/actions_queue.json'
+CALENDAR_JOBS_LAST_RUNS = {}
+CALENDAR_JOBS_DELIVERIES_FILEPATH = './data/calendar_jobs_deliveries.json'
+CALENDAR_JOBS_DELIVERIES = {}
+CALENDAR_JOBS: List = []
 
 HELP_ASSISTANT: HelpAssistant
+GARBAGE_CLASSIFIER: GarbageClassifier
+GARBAGE_CLEANING_CONFIGS: Dict[int, Dict] = {}
 
 
 def get_default_context():
@@ -154,22 +182,225 @@ def get_default_context():
     }
 
 
-def is_emoji(s):
-    for symbol in set(s.lower()):
-        if symbol not in emoji.EMOJI_DATA:
-            return False
+# zero width joiner, variation selectors, skin tones and tag characters are parts of the previous emoji
+EMOJI_COMPONENTS_RANGES = [(0x200D, 0x200D), (0xFE0E, 0xFE0F), (0x1F3FB, 0x1F3FF), (0xE0020, 0xE007F)]
 
-    return True
+
+def is_emoji_component(symbol: str) -> bool:
+    code = ord(symbol)
+    for start, end in EMOJI_COMPONENTS_RANGES:
+        if start <= code <= end:
+            return True
+    return False
+
+
+class GarbageClassifier:
+    """
+    Decides in a single scan of the message whether it is garbage: sticker, gif, emoji only or repeated symbol.
+
+    Emoji are matched by the longest known sequence starting with the symbol, so multi-codepoint emoji (flags,
+    ZWJ sequences, skin tones, keycaps) are counted as one emoji. Whitespaces are ignored.
+    """
+
+    def __init__(self):
+        self.emojis = set(emoji.EMOJI_DATA.keys())
+        self.emoji_lengths: Dict[str, List[int]] = {}
+        for emoji_sequence in self.emojis:
+            self.emoji_lengths.setdefault(emoji_sequence[0], []).append(len(emoji_sequence))
+        for first_symbol, lengths in self.emoji_lengths.items():
+            self.emoji_lengths[first_symbol] = sorted(set(lengths), reverse=True)
+
+    def classify_text(self, text: str, max_length: int or None = None, max_emoji: int or None = None,
+                      min_repeated_length: int = 1) -> str or None:
+        if not text or (max_length is not None and len(text) > max_length):
+            return None
+
+        is_emoji_only = True
+        emoji_count = 0
+        is_repeated_only = True
+        repeated_symbol = None
+        symbols_count = 0
+
+        i = 0
+        text_length = len(text)
+        while i < text_length and (is_emoji_only or is_repeated_only):
+            symbol = text[i]
+
+            if symbol.isspace() or (emoji_count and is_emoji_component(symbol)):
+                i += 1
+                continue
+
+            matched_length = 0
+            if is_emoji_only:
+                for length in self.emoji_lengths.get(symbol, ()):
+                    if text[i:i + length] in self.emojis:
+                        matched_length = length
+                        break
+
+                if matched_length:
+                    emoji_count += 1
+                else:
+                    is_emoji_only = False
+
+            if is_repeated_only:
+                token = text[i:i + matched_length] if matched_length else symbol.lower()
+                if repeated_symbol is None:
+                    repeated_symbol = token
+                elif token != repeated_symbol:
+                    is_repeated_only = False
+                symbols_count += 1
+
+            i += matched_length or 1
+
+        if is_emoji_only and emoji_count > 0:
+            if max_emoji is None or emoji_count <= max_emoji:
+                return 'emoji'
+            return None
+
+        if is_repeated_only and repeated_symbol is not None and symbols_count >= min_repeated_length:
+            return 'repeated'
+
+        return None
+
+    def classify(self, message: Message, config: Dict) -> str or None:
+        if message.sticker:
+            return 'sticker' if config.get('sticker') is not None else None
+
+        if message.animation:
+            return 'gif' if config.get('gif') is not None else None
+
+        garbage_type = self.classify_text(message.text,
+                                          config.get('max_length'),
+                                          config.get('max_emoji'),
+                                          config.get('min_repeated_length', 1))
+        if garbage_type is not None and config.get(garbage_type) is None:
+            return None
+
+        return garbage_type
+
+
+def build_garbage_cleaning_configs() -> Dict[int, Dict]:
+    """
+    Garbage cleaning timeouts and thresholds per chat, chat "clean_garbage" settings override service defaults.
+    Timeout set to null disables cleaning of this garbage type.
+    """
+    defaults = dict(CONFIGS['service']['scheduler']['clean_garbage'])
+    # repeated symbols were cleaned with emoji timeout before it was configurable
+    defaults.setdefault('repeated', defaults.get('emoji'))
+
+    configs = {}
+    for building_config in CONFIGS['buildings'].values():
+        for chat in building_config['groups']:
+            configs[chat['id']] = {**defaults, **chat.get('clean_garbage', {})}
+
+    return configs
 
 
-def is_repeated_symbol(s):
-    return len(set(s.lower())) == 1
+class TraceSpan:
+    __slots__ = ('name', 'category', 'trace_id', 'args')
+
+    def __init__(self, name: str, category: str, trace_id: int, args: Dict):
+        self.name = name
+        self.category = category
+        self.trace_id = trace_id
+        self.args = args
+
+
+CURRENT_TRACE_SPAN: contextvars.ContextVar[TraceSpan or None] = contextvars.ContextVar('current_trace_span',
+                                                                                       default=None)
+
+
+class Tracer:
+    """
+    Writes spans as Chrome trace events, one JSON per line, to a rotating file.
+    Spans of one update share the trace ID, which is used as a thread ID so every update is shown as its own row.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.logger = logging.getLogger('traces')
+        self.logger.propagate = False
+        self.handler: logging.Handler or None = None
+        self.next_trace_id = itertools.count(1)
+        self.pid = os.getpid()
+
+    def configure(self, enabled: bool, filepath: str, max_bytes: int, backups: int) -> None:
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+
+        self.enabled = enabled
+        if enabled:
+            self.handler = logging.handlers.RotatingFileHandler(filepath, maxBytes=max_bytes, backupCount=backups,
+                                                                encoding='utf8')
+            self.handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(self.handler)
+            self.logger.setLevel(logging.INFO)
+
+    def write(self, span: TraceSpan, started_wall: int, duration: float) -> None:
+        self.logger.info(json.dumps({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': started_wall,
+            'dur': int(duration * 1000000),
+            'pid': self.pid,
+            'tid': span.trace_id,
+            'args': span.args
+        }, ensure_ascii=False, default=str))
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def trace_span(name: str, category: str = 'bot', **args):
+    if not TRACER.enabled:
+        yield None
+        return
+
+    parent = CURRENT_TRACE_SPAN.get()
+    trace_id = parent.trace_id if parent is not None else next(TRACER.next_trace_id)
+    span = TraceSpan(name, category, trace_id, args)
+    token = CURRENT_TRACE_SPAN.set(span)
+    started_wall = time.time_ns() // 1000
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        CURRENT_TRACE_SPAN.reset(token)
+        TRACER.write(span, started_wall, time.perf_counter() - started)
+
+
+def traced(name: str = None, category: str = 'bot'):
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not TRACER.enabled:
+                    return await func(*args, **kwargs)
+                with trace_span(span_name, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with trace_span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def private_or_known_chat_only(func):
     @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-        is_found_chat, _, _, _, _, _ = identify_chat_by_tg_update(update)
+        with trace_span('private_or_known_chat_only', 'check'):
+            is_found_chat, _, _, _, _, _ = identify_chat_by_tg_update(update)
         if update.effective_chat.type != 'private' and not is_found_chat:
             await bot_send_message_this_command_bot_not_allowed_here(update, context)
             return
@@ -180,7 +411,8 @@ def private_or_known_chat_only(func):
 def known_chat_only(func):
     @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-        is_found_chat, _, _, _, _, _ = identify_chat_by_tg_update(update)
+        with trace_span('known_chat_only', 'check'):
+            is_found_chat, _, _, _, _, _ = identify_chat_by_tg_update(update)
         if not is_found_chat:
             await bot_send_message_this_command_bot_not_allowed_here(update, context)
             return
@@ -191,7 +423,8 @@ def known_chat_only(func):
 def admin_chat_only(func):
     @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-        is_found_chat, chat_building, is_admin_chat, _, _, _ = identify_chat_by_tg_update(update)
+        with trace_span('admin_chat_only', 'check'):
+            is_found_chat, chat_building, is_admin_chat, _, _, _ = identify_chat_by_tg_update(update)
         if not is_admin_chat:
             await bot_send_message_this_command_bot_not_allowed_here(update, context)
             return
@@ -205,8 +438,9 @@ def authorized_only(func):
         # ignore messaged from non-users (e.g. technical stuff)
         if update.effective_user is None:
             return
-        user = USERS_CACHE.get_user(update)
-        if not user.is_identified():
+        with trace_span('authorized_only', 'check'):
+            is_authorized = is_resident(update.effective_user.id)
+        if not is_authorized:
             await bot_send_message_user_not_authorized(update, context)
             return
         return await func(update, context, *args, **kwargs)
@@ -219,8 +453,9 @@ def ignore_unauthorized(func):
         # ignore messaged from non-users (e.g. technical stuff)
         if update.effective_user is None:
             return
-        user = USERS_CACHE.get_user(update)
-        if not user.is_identified():
+        with trace_span('ignore_unauthorized', 'check'):
+            is_authorized = is_resident(update.effective_user.id)
+        if not is_authorized:
             return
         return await func(update, context, *args, **kwargs)
     return wrapper
@@ -229,106 +464,176 @@ def ignore_unauthorized(func):
 class User:
     def __init__(self, telegram_id: int, cache: UsersCache):
         self.load_time = time.time()
+        self.tables_generations = get_tables_generations(telegram_id)
         self.cache = cache
         self.telegram_id = telegram_id
-        self.db_entries = pd.DataFrame()
-        self.person = None
-        self.phone = None
-        self.add_to_group = None
-        self.own_object_types = []
-        self.from_sections = []
-        self.related_users_objects = []
-        self.building = None
-        self.objects = []
-
-        self.context = get_default_context()
+        self.context_size = 0
+        self.cached_size = 0
+
+    # Facets below are computed on first access and memoized for the lifetime of the cached user
 
+    @cached_property
+    @traced('User.db_entries', 'user')
+    def db_entries(self) -> DataFrame:
+        buildings_rows = []
         for building, table in DB.items():
             rows = table.loc[table['telegram'] == str(self.telegram_id)].copy()
             rows['building'] = building
-            self.building = building
-            if self.db_entries.empty:
-                self.db_entries = rows
-            else:
-                # TODO: fix this, this merge will fail
-                self.db_entries = self.db_entries.merge(rows)
+            if not rows.empty:
+                buildings_rows.append(rows)
+        if not buildings_rows:
+            return pd.DataFrame()
+        return pd.concat(buildings_rows)
+
+    @cached_property
+    def building(self) -> str or None:
+        building = RESIDENTS_INDEX.find_building_by_telegram(self.telegram_id)
+        if building is None and DB:
+            building = list(DB.keys())[-1]
+        return building
+
+    @cached_property
+    def _first_entry(self) -> Dict or None:
+        if not self.has_any_object():
+            return None
+        return self.db_entries.iloc[0].to_dict()
+
+    @cached_property
+    def person(self) -> Dict or None:
+        entry = self._first_entry
+        if entry is None:
+            return None
+        return {
+            'name': entry['name'],
+            'surname': entry['surname'],
+            'patronymic': entry['patronymic']
+        }
 
-        if self.has_any_object():
-            effective_index = 0
-            self.person = {
-                'name': self.db_entries['name'].iloc[effective_index],
-                'surname': self.db_entries['surname'].iloc[effective_index],
-                'patronymic': self.db_entries['patronymic'].iloc[effective_index]
-            }
+    @cached_property
+    def phone(self) -> Dict or None:
+        entry = self._first_entry
+        if entry is None or not entry['phone']:
+            return None
+        return {
+            'number': entry['phone'],
+            'visible': entry['show_phone'] == 'YES'
+        }
 
-            self.add_to_group = self.db_entries['added_to_group'].iloc[effective_index] == 'YES'
-            self.hidden = self.db_entries['hidden'].iloc[effective_index] == 'YES'
-            self.deleted = self.db_entries['deleted'].iloc[effective_index] == 'YES'
+    @cached_property
+    def add_to_group(self) -> bool or None:
+        entry = self._first_entry
+        return None if entry is None else entry['added_to_group'] == 'YES'
+
+    @cached_property
+    def hidden(self) -> bool:
+        entry = self._first_entry
+        return entry is not None and entry['hidden'] == 'YES'
+
+    @cached_property
+    def deleted(self) -> bool:
+        entry = self._first_entry
+        return entry is not None and entry['deleted'] == 'YES'
+
+    @cached_property
+    def parking_notifications(self) -> bool or None:
+        entry = self._first_entry
+        if entry is None:
+            return None
+        if entry['parking_notifications'] == 'YES':
+            return True
+        elif entry['parking_notifications'] == 'NO':
+            return False
+        return None
 
-            parking_notifications = self.db_entries['parking_notifications'].iloc[effective_index]
-            if parking_notifications == 'YES':
-                self.parking_notifications = True
-            elif parking_notifications == 'NO':
-                self.parking_notifications = False
+    @cached_property
+    def own_object_types(self) -> List[str]:
+        if not self.has_any_object():
+            return []
+        return self.db_entries['object_type'].unique()
+
+    @cached_property
+    def _objects_and_sections(self) -> (List[Dict], List[Dict]):
+        objects = []
+        from_sections = []
+        if not self.has_any_object():
+            return objects, from_sections
+
+        for row in self.db_entries.to_dict('records'):
+            if row['object_type'] == 'мм':
+                obj_type = 'p'
+                section_id = obj_type
+            elif row['object_type'] == 'кл':
+                obj_type = 's'
+                section_id = obj_type
             else:
-                self.parking_notifications = None
-
-            phone_number = self.db_entries['phone'].iloc[effective_index]
-            if phone_number:
-                self.phone = {
-                    'number': phone_number,
-                    'visible': self.db_entries['show_phone'].iloc[effective_index] == 'YES'
-                }
-
-            self.own_object_types = self.db_entries['object_type'].unique()
-
+                section_id = row['entrance']
+                obj_type = 'f'
+
+            from_sections.append({
+                'type': obj_type,
+                'number': int(row['entrance']),
+                'id': section_id
+            })
+
+            objects.append({
+                'property_id': row['property_id'],
+                'building': row['building'],
+                'floor': int(row['floor']),
+                'section': section_id,
+                'section_raw': row['entrance'],
+                'type': row['object_type'],
+                'number': row['number'],
+                'floor_position': int(row['floor_position']),
+            })
+        return objects, from_sections
+
+    @property
+    def objects(self) -> List[Dict]:
+        return self._objects_and_sections[0]
+
+    @property
+    def from_sections(self) -> List[Dict]:
+        return self._objects_and_sections[1]
+
+    @cached_property
+    @traced('User.related_users_objects', 'user')
+    def related_users_objects(self) -> DataFrame:
+        # TODO: building correct objects from rows
+        related_users_dfs = []
+        if self.has_any_object():
+            own_columns = ['object_type', 'number', 'name', 'surname', 'patronymic']
+            for building, own_rows in self.db_entries.groupby('building'):
+                own_objects = own_rows[own_columns].rename(
+                    columns={'name': '_name', 'surname': '_surname', 'patronymic': '_patronymic'})
+                merged = DB[building].merge(own_objects, on=['object_type', 'number'])
+                related = merged[
+                    (merged['name'] != merged['_name']) |
+                    (merged['surname'] != merged['_surname']) |
+                    (merged['patronymic'] != merged['_patronymic'])
+                    ].drop(columns=['_name', '_surname', '_patronymic'])
+                if not related.empty:
+                    related_users_dfs.append(related)
+
+        if not related_users_dfs:
             related_users_df = pd.DataFrame(columns=DF_COLUMNS)
             related_users_df['building'] = None
-            for index, row in self.db_entries.iterrows():
-                table = DB[row['building']]
-
-                if row['object_type'] == 'мм':
-                    obj_type = 'p'
-                    section_id = obj_type
-                elif row['object_type'] == 'кл':
-                    obj_type = 's'
-                    section_id = obj_type
-                else:
-                    section_id = row['entrance']
-                    obj_type = 'f'
-
-                self.from_sections.append({
-                    'type': obj_type,
-                    'number': int(row['entrance']),
-                    'id': section_id
-                })
-
-                self.objects.append({
-                    'property_id': row['property_id'],
-                    'building': row['building'],
-                    'floor': int(row['floor']),
-                    'section': section_id,
-                    'section_raw': row['entrance'],
-                    'type': row['object_type'],
-                    'number': row['number'],
-                    'floor_position': int(row['floor_position']),
-                })
-
-                related_users_found_df = table[
-                    (table['object_type'] == row['object_type']) &
-                    (table['number'] == row['number']) &
-                    ((table['name'] != row['name']) |
-                     (table['surname'] != row['surname']) |
-                     (table['patronymic'] != row['patronymic']))
-                    ]
-                if not related_users_found_df.empty:
-                    related_users_df = pd.concat([related_users_df, related_users_found_df])
-                # TODO: building correct objects from rows
-
-            self.from_sections = self.from_sections
-            self.related_users_objects = related_users_df
-
-            self.load_context()
+            return related_users_df
+        return pd.concat(related_users_dfs)
+
+    @cached_property
+    @traced('User.context', 'user')
+    def context(self) -> Dict:
+        context = get_default_context()
+        if self.is_identified():
+            user_filepath = self.get_user_filepath()
+            if os.path.isfile(user_filepath):
+                try:
+                    with open(user_filepath, 'r', encoding='utf8') as stream:
+                        context = json.load(stream)
+                    self.context_size = os.path.getsize(user_filepath)
+                except Exception:
+                    logging.error(f'!!! Failed to read user data {self.telegram_id} !!!')
+        return context
 
     def __hash__(self):
         return hash(self.telegram_id) + hash(self.load_time)
@@ -346,7 +651,7 @@ class User:
         return True
 
     def is_identified(self):
-        return self.person is not None
+        return is_resident(self.telegram_id)
 
     def has_any_object(self):
         return not self.db_entries.empty
@@ -358,30 +663,35 @@ class User:
     def get_user_filepath(self):
         return f'./users/{self.telegram_id}.json'
 
-    def load_context(self):
-        user_filepath = self.get_user_filepath()
-        if os.path.isfile(user_filepath):
-            try:
-                with open(user_filepath, 'r', encoding='utf8') as stream:
-                    self.context = json.load(stream)
-            except Exception:
-                logging.error(f'!!! Failed to read user data {self.telegram_id} !!!')
-
     def delayed_context_save(self):
-        if USERS_CONTEXT_SAVE_TASK is not None:
+        if SCHEDULER.has_job('users_context_save'):
             self.cache.schedule_user_context_save(self)
         else:
             logging.debug(f'Autosave disabled, saving {self.telegram_id} synchronously...')
             self.save_context()
 
     def save_context(self):
+        if 'context' not in self.__dict__:
+            # context was never loaded, nothing could change
+            return
+
         user_filepath = self.get_user_filepath()
         with open(user_filepath, 'w', encoding='utf8') as stream:
             json.dump(self.context, stream, ensure_ascii=False)
+            self.context_size = stream.tell()
 
         if self in self.cache.scheduled_saves:
             self.cache.scheduled_saves.remove(self)
 
+    def get_approximate_size(self) -> int:
+        # only facets loaded so far are counted, tables rows are estimated by amount
+        size = USER_BASE_SIZE + self.context_size
+        for facet in ('db_entries', 'related_users_objects'):
+            table = self.__dict__.get(facet)
+            if table is not None:
+                size += len(table.index) * USER_TABLE_ROW_SIZE
+        return size
+
     def get_fullname(self) -> str:
         if not self.is_identified():
             return ''
@@ -451,7 +761,7 @@ class User:
         self.update_table_value('phone', phone)
 
     def change_phone_visibility(self, visibility_bool):
-        self.update_table_value('phone_visibility', visibility_bool)
+        self.update_table_value('show_phone', visibility_bool)
 
     def lock_bot_access(self):
         self.context['private_chat']['is_access_granted'] = False
@@ -534,8 +844,7 @@ class User:
 
     def evict(self) -> None:
         self.save_context()
-        if self.cache.users.get(self.telegram_id):
-            del self.cache.users[self.telegram_id]
+        self.cache.remove(self, 'evict')
 
     def deactivate(self) -> None:
         self.lock_bot_access()
@@ -543,11 +852,11 @@ class User:
         self.evict()
 
     def update_table_values(self, values: List[List[str, str or int]]):
-        update_table(self.building, values)
+        update_table(self.building, self.telegram_id, values)
         self.evict()
 
     def update_table_value(self, column_name: str, value: str or int):
-        update_table(self.building, [[column_name, value]])
+        update_table(self.building, self.telegram_id, [[column_name, value]])
         self.evict()
 
     def get_floors(self, building: int, section: str) -> List[int]:
@@ -564,6 +873,7 @@ class User:
                 result.append(obj['number'])
         return result
 
+    @traced('User._get_neighbours', 'pandas')
     def _get_neighbours(self, building=None, section: str = None, number: str or int = None,
                         object_type: str = None) -> DataFrame:
         if not building:
@@ -604,7 +914,7 @@ class User:
         return all_neighbours
 
     def get_neighbours(self, building=None, section: str = None, number: str or int = None, object_type: str = None) -> \
-    Dict[str, Dict[str, Dict[str, Any[str, List[Any[User, List[str]]]]]]]:
+    Dict[str, Dict[str, Dict[str, Any[str, List[Any[ResidentView, List[str]]]]]]]:
         neighbours_table = self._get_neighbours(building, section, number, object_type)
         return rebuild_neighbours_dict_from_table(neighbours_table)
 
@@ -645,8 +955,90 @@ async def is_user_added_to_groups(telegram_id: int, groups_ids: List[int]) -> bo
     return True
 
 
+class ResidentView:
+    """
+    Compact read-only resident record for rendering, built from tables on sync.
+    Use full User only when context or changes are needed.
+    """
+
+    __slots__ = ('telegram_id', 'name', 'surname', 'patronymic', 'hidden', 'phone', 'parking_notifications')
+
+    def __init__(self, telegram_id: int, name: str, surname: str, patronymic: str, hidden: bool,
+                 phone: Dict or None, parking_notifications: bool or None):
+        for slot, value in zip(self.__slots__,
+                               (telegram_id, name, surname, patronymic, hidden, phone, parking_notifications)):
+            object.__setattr__(self, slot, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ResidentView is read-only')
+
+    @classmethod
+    def from_row(cls, row: Dict) -> ResidentView:
+        if row['parking_notifications'] == 'YES':
+            parking_notifications = True
+        elif row['parking_notifications'] == 'NO':
+            parking_notifications = False
+        else:
+            parking_notifications = None
+
+        phone = None
+        if row['phone']:
+            phone = {
+                'number': row['phone'],
+                'visible': row['show_phone'] == 'YES'
+            }
+
+        return cls(int(row['telegram']), row['name'], row['surname'], row['patronymic'], row['hidden'] == 'YES',
+                   phone, parking_notifications)
+
+    def get_shortname(self) -> str:
+        shortname = f'{self.name}'
+        if self.surname:
+            shortname += f' {self.surname[0]}.'
+        return shortname
+
+    def get_linked_shortname(self) -> str:
+        return '[' + encode_markdown(self.get_shortname()) + '](tg://user?id=' + str(self.telegram_id) + ')'
+
+    def get_seminame(self) -> str:
+        return f'{self.name} {self.surname}'
+
+    def get_linked_seminame(self) -> str:
+        return '[' + encode_markdown(self.get_seminame()) + '](tg://user?id=' + str(self.telegram_id) + ')'
+
+    def get_public_phone(self):
+        if not self.phone:
+            return 'не указан'
+        if self.phone.get('visible', False):
+            return '+' + self.phone['number']
+        else:
+            return 'скрыт'
+
+
+def build_residents_views(building) -> Dict[str, ResidentView]:
+    # same as User, resident details are taken from the first row of the resident
+    residents_views = {}
+    for row in DB[building].to_dict('records'):
+        if row['telegram'] and row['telegram'] not in residents_views:
+            if not row['telegram'].isdigit():
+                # filled manually in the table, e.g. a username instead of the id
+                logging.error(f'Building {building}: resident telegram "{row["telegram"]}" is not an id, skipped')
+                continue
+            residents_views[row['telegram']] = ResidentView.from_row(row)
+    return residents_views
+
+
+def get_resident_view(telegram_id: str or int) -> ResidentView or None:
+    for building_residents_views in RESIDENTS_VIEWS.values():
+        resident_view = building_residents_views.get(str(telegram_id))
+        if resident_view is not None:
+            return resident_view
+    return None
+
+
+@traced(category='pandas')
 def rebuild_neighbours_dict_from_table(origin_table: DataFrame) -> Dict[
-    str, Dict[str, Dict[str, Any[str, List[Any[User, List[str]]]]]]]:
+    str, Dict[str, Dict[str, Any[str, List[Any[ResidentView, List[str]]]]]]]:
     table = origin_table.copy()
     table.number = table.number.astype(int)
     table = table.sort_values(by=['number'], ascending=True)
@@ -669,7 +1061,7 @@ def rebuild_neighbours_dict_from_table(origin_table: DataFrame) -> Dict[
             }
 
         if row['telegram']:
-            user = USERS_CACHE.get_user(int(row['telegram']))
+            user = get_resident_view(row['telegram'])
         else:
             user = [encode_markdown(row['name']), encode_markdown(row['surname'])]
         neighbours[floor][obj_number]['users'].append(user)
@@ -679,7 +1071,7 @@ def rebuild_neighbours_dict_from_table(origin_table: DataFrame) -> Dict[
         for obj_number, obj in floor_objs.items():
             only_users = []
             for user in obj['users']:
-                if isinstance(user, User):
+                if isinstance(user, ResidentView):
                     only_users.append(user)
             if only_users:
                 neighbours[floor_number][obj_number]['users'] = only_users
@@ -691,57 +1083,75 @@ def encode_markdown(string: str):
     return telegram.helpers.escape_markdown(string, version=2)
 
 
+PERSONS_TYPES_BY_USER_TYPE = {
+    'собственник': 'owners',
+    'арендатор': 'rents',
+    'пользователь': 'residents',
+}
+
+
+def build_building_directory(building) -> Dict[tuple, Dict]:
+    # single pass over the table, object details are taken from the first row of the object
+    directory = {}
+    for person in DB[building].to_dict('records'):
+        object_key = (person['object_type'], person['number'])
+        building_object = directory.get(object_key)
+        if building_object is None:
+            building_object = {
+                'property_id': person['property_id'],
+                'entrance': person['entrance'],
+                'floor': person['floor'],
+                'area': person['area'],
+                'persons': {
+                    'owners': [],
+                    'rents': [],
+                    'residents': []
+                }
+            }
+            directory[object_key] = building_object
+
+        person_type = PERSONS_TYPES_BY_USER_TYPE.get(person['user_type'])
+        if person_type:
+            building_object['persons'][person_type].append(person)
+
+    return directory
+
+
 def get_object_persons(building, object_type_name: str, obj_n: str):
-    table = DB[building]
-    persons_raw = table[(table['object_type'] == object_type_name) & (table['number'] == obj_n)]
     persons = {
         'owners': [],
         'rents': [],
         'residents': []
     }
-    for index, person_raw in persons_raw.iterrows():
-        if person_raw.get('telegram'):
-            person = USERS_CACHE.get_user(person_raw['telegram'])
-        else:
-            person = person_raw
-
-        person_type = None
-        if person_raw['user_type'] == 'собственник':
-            person_type = 'owners'
-        elif person_raw['user_type'] == 'арендатор':
-            person_type = 'rents'
-        elif person_raw['user_type'] == 'пользователь':
-            person_type = 'residents'
 
-        if person_type:
+    building_object = BUILDINGS_DIRECTORY[building].get((object_type_name, obj_n))
+    if building_object is None:
+        return persons
+
+    for person_type, persons_raw in building_object['persons'].items():
+        for person_raw in persons_raw:
+            person = None
+            if person_raw.get('telegram'):
+                person = get_resident_view(person_raw['telegram'])
+            if person is None:
+                # not a resident or telegram is not an id, skipped by build_residents_views()
+                person = person_raw
             persons[person_type].append(person)
 
     return persons
 
 
 def get_persons_per_objects(building) -> Dict:
-    table = DB[building]
-
+    """
+    Returns all building objects grouped by object type, persons of objects are raw table records
+    """
     building_objects = {}
     for object_type_name in OBJECT_TYPES_NAMES.keys():
         building_objects[object_type_name] = {}
 
-        objects_ndarray = table[table['object_type'] == object_type_name]['number'].unique()
-        for obj_n in objects_ndarray:
-            obj_row = table[(table['object_type'] == object_type_name) & (table['number'] == obj_n)].iloc[0]
-            entrance = obj_row.entrance
-            floor = obj_row.floor
-            area = obj_row.area
-            property_id = obj_row.property_id
-
-            persons = get_object_persons(building, object_type_name, obj_n)
-            building_objects[object_type_name][obj_n] = {
-                'property_id': property_id,
-                'entrance': entrance,
-                'floor': floor,
-                'area': area,
-                'persons': persons
-            }
+    for (object_type_name, obj_n), building_object in BUILDINGS_DIRECTORY[building].items():
+        if object_type_name in building_objects:
+            building_objects[object_type_name][obj_n] = building_object
 
     return building_objects
 
@@ -757,31 +1167,287 @@ def get_all_users(building) -> List:
     return users
 
 
+METRICS_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and latency histograms with labels, rendered in Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Dict] = {}
+
+    def _register(self, name: str, metric_type: str, description: str, buckets=None) -> None:
+        self.metrics[name] = {
+            'type': metric_type,
+            'description': description,
+            'buckets': buckets,
+            'values': {}
+        }
+
+    def counter(self, name: str, description: str) -> None:
+        self._register(name, 'counter', description)
+
+    def gauge(self, name: str, description: str) -> None:
+        self._register(name, 'gauge', description)
+
+    def histogram(self, name: str, description: str, buckets=METRICS_DEFAULT_BUCKETS) -> None:
+        self._register(name, 'histogram', description, tuple(buckets))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        values = self.metrics[name]['values']
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        self.metrics[name]['values'][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        metric = self.metrics[name]
+        key = tuple(sorted(labels.items()))
+        histogram = metric['values'].get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            metric['values'][key] = histogram
+
+        for i, upper_bound in enumerate(metric['buckets']):
+            if value <= upper_bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+        histogram['max'] = max(histogram['max'], value)
+
+    def get_values(self, name: str) -> Dict[tuple, Any]:
+        return self.metrics[name]['values']
+
+    def get_quantile(self, name: str, histogram: Dict, quantile: float) -> float:
+        # upper bound of the bucket, exact values are not stored
+        rank = quantile * histogram['count']
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.metrics[name]['buckets'], histogram['buckets']):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return upper_bound
+        return histogram['max']
+
+    @staticmethod
+    def _format_labels(labels, extra: tuple = ()) -> str:
+        labels = tuple(labels) + extra
+        if not labels:
+            return ''
+        escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric["description"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+            for labels, value in metric['values'].items():
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+                    continue
+
+                cumulative = 0
+                for upper_bound, bucket_count in zip(metric['buckets'], value['buckets']):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{self._format_labels(labels, (("le", upper_bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{self._format_labels(labels, (("le", "+Inf"),))} {value["count"]}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+METRICS.histogram('bot_handler_duration_seconds', 'Update handlers execution time')
+METRICS.counter('bot_handler_errors_total', 'Update handlers failures')
+METRICS.histogram('tables_sync_duration_seconds', 'Sheet read and processing time per building and sheet')
+METRICS.counter('users_cache_requests_total', 'Users cache lookups by result')
+METRICS.counter('users_cache_evictions_total', 'Users evicted from cache by reason')
+METRICS.histogram('actions_queue_lag_seconds', 'Delay of queued actions after their planned time')
+METRICS.histogram('telegram_api_request_duration_seconds', 'Bot API requests time without rate limiter wait')
+METRICS.counter('telegram_api_errors_total', 'Bot API requests failures')
+METRICS.gauge('actions_queue_size', 'Queued actions')
+METRICS.gauge('users_cache_size', 'Cached users')
+METRICS.gauge('users_save_queue_size', 'Users waiting for context save')
+METRICS.gauge('tables_write_back_pending', 'Table cells waiting to be written')
+METRICS.gauge('tables_generation', 'Tables changes since start')
+METRICS.gauge('updates_processing', 'Updates processed at the moment')
+METRICS.gauge('scheduler_job_lag_seconds', 'Last delay of scheduled job start')
+METRICS.histogram('event_loop_lag_seconds', 'Event loop heartbeat delay',
+                  buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+METRICS.counter('event_loop_stalls_total', 'Event loop blocks longer than threshold by blocking bot function')
+
+
+def update_metrics_gauges() -> None:
+    METRICS.set('actions_queue_size', len(QUEUED_ACTIONS))
+    METRICS.set('users_cache_size', len(USERS_CACHE.users))
+    METRICS.set('users_save_queue_size', len(USERS_CACHE.scheduled_saves))
+    METRICS.set('tables_write_back_pending', TABLES_WRITE_BACK.get_pending_count())
+    METRICS.set('tables_generation', TABLES_GENERATION)
+    if 'TG_UPDATE_PROCESSOR' in globals():
+        METRICS.set('updates_processing', TG_UPDATE_PROCESSOR.processing)
+    for job_name, job_stats in SCHEDULER.get_stats().items():
+        METRICS.set('scheduler_job_lag_seconds', job_stats['last_lag'], job=job_name)
+
+
+def measure_handler(callback):
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update: Update, context: CallbackContext):
+        started = time.perf_counter()
+        try:
+            with trace_span(name, 'handler'):
+                return await callback(update, context)
+        except Exception:
+            METRICS.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            METRICS.observe('bot_handler_duration_seconds', time.perf_counter() - started, handler=name)
+    return wrapper
+
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # headers are not used
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+        request = request_line.decode('latin-1').split()
+        if len(request) >= 2 and request[0] == 'GET' and request[1].split('?')[0] == '/metrics':
+            update_metrics_gauges()
+            status = '200 OK'
+            body = METRICS.render_prometheus().encode('utf8')
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+
+        writer.write(f'HTTP/1.1 {status}\r\n'
+                     f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    global METRICS_SERVER
+
+    metrics_config = CONFIGS['service'].get('metrics')
+    if not metrics_config:
+        return
+
+    METRICS_SERVER = await asyncio.start_server(handle_metrics_request,
+                                                metrics_config.get('listen', '127.0.0.1'),
+                                                metrics_config.get('port', 9090))
+    logging.info(f'Metrics are served on port {metrics_config.get("port", 9090)}')
+
+
+def stop_metrics_server():
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.close()
+
+
 class UsersCache:
+    """
+    Identified users in LRU order, bounded by amount and approximate memory. Users become stale after
+    caches_stale_interval since loading, the expiry heap keeps them in stale time order, so staling touches only
+    expired users. Users loaded before the last change of their buildings tables are reloaded on access, keeping
+    the loaded context.
+    """
+
     def __init__(self):
-        self.users: Dict[int, User] = {}
+        self.users: OrderedDict[int, User] = OrderedDict()
+        self.expiry_heap: List[tuple] = []
+        self.max_size = 1000
+        self.max_memory = 64 * 1024 * 1024
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions: Dict[str, int] = {}
         self.last_save_time = time.time()
         self.scheduled_saves: set[User] = set()
 
+    def configure(self, max_size: int, max_memory: int) -> None:
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self._shrink()
+
+    @traced('UsersCache.get_user', 'cache')
     def get_user(self, incoming_user_update: Update or int) -> User:
         if isinstance(incoming_user_update, Update):
             incoming_user_id = int(incoming_user_update.effective_user.id)
         else:
             incoming_user_id = int(incoming_user_update)
 
-        # TODO: temporary solution - disabled caches and force reloading
-        # if self.users.get(incoming_user_id):
-        #     return self.users[incoming_user_id]
-        USERS_CACHE.evict()
-        reload_tables()
-
-        user = User(incoming_user_id, self)
+        user = outdated_user = self.users.get(incoming_user_id)
+        if user is not None:
+            if user.tables_generations == get_tables_generations(incoming_user_id):
+                self.hits += 1
+                METRICS.inc('users_cache_requests_total', result='hit')
+                self.users.move_to_end(incoming_user_id)
+                # facets loaded since the last access are accounted now
+                self._resize(user)
+                self._shrink()
+                return user
+            self.remove(user, 'tables')
+
+        self.misses += 1
+        METRICS.inc('users_cache_requests_total', result='miss')
+        with trace_span('User.__init__', 'user', telegram_id=incoming_user_id):
+            user = User(incoming_user_id, self)
+        if outdated_user is not None and 'context' in outdated_user.__dict__:
+            # handlers may still hold the outdated user, both users change and save the same context
+            user.context = outdated_user.context
+            user.context_size = outdated_user.context_size
         if user.is_identified():
             self.users[incoming_user_id] = user
-            return self.users[incoming_user_id]
+            self._resize(user)
+            stale_interval = CONFIGS['service']['scheduler']['caches_stale_interval']
+            heapq.heappush(self.expiry_heap, (user.load_time + stale_interval, incoming_user_id, user.load_time))
+            self._shrink()
 
         return user
 
+    def _resize(self, user: User) -> None:
+        size = user.get_approximate_size()
+        self.memory += size - user.cached_size
+        user.cached_size = size
+
+    def _shrink(self) -> None:
+        while len(self.users) > self.max_size:
+            self.remove(next(iter(self.users.values())), 'size')
+        # the most recent user is kept even if it alone is over the budget
+        while self.memory > self.max_memory and len(self.users) > 1:
+            self.remove(next(iter(self.users.values())), 'memory')
+
+    def remove(self, user: User, reason: str) -> None:
+        if self.users.get(user.telegram_id) is not user:
+            return
+
+        if user in self.scheduled_saves:
+            user.save_context()
+
+        del self.users[user.telegram_id]
+        self.memory -= user.cached_size
+        self.evictions[reason] = self.evictions.get(reason, 0) + 1
+        METRICS.inc('users_cache_evictions_total', reason=reason)
+
+        # entries of removed users stay in the heap until expired, it is rebuilt when they prevail
+        if len(self.expiry_heap) > 2 * len(self.users) + 100:
+            self.expiry_heap = [entry for entry in self.expiry_heap
+                                if entry[1] in self.users and self.users[entry[1]].load_time == entry[2]]
+            heapq.heapify(self.expiry_heap)
+
     def save_users(self):
         for user in list(self.scheduled_saves):
             user.save_context()
@@ -800,7 +1466,11 @@ class UsersCache:
         return {
             "cached_users": cached_users,
             "users_save_queue": waiting_for_saving_users,
-            "time_since_last_save": time.time() - self.last_save_time
+            "time_since_last_save": time.time() - self.last_save_time,
+            "memory": self.memory,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": dict(self.evictions)
         }
 
     def schedule_user_context_save(self, user: User):
@@ -816,21 +1486,23 @@ class UsersCache:
         stale_interval = CONFIGS['service']['scheduler']['caches_stale_interval']
 
         current_time = time.time()
+        while self.expiry_heap and self.expiry_heap[0][0] <= current_time:
+            _, user_tg_id, load_time = heapq.heappop(self.expiry_heap)
+            cached_user = self.users.get(user_tg_id)
+            # the user could be removed or reloaded since the entry was pushed
+            if cached_user is None or cached_user.load_time != load_time:
+                continue
 
-        for user_tg_id in list(self.users.keys()):
-            cached_user = self.users[user_tg_id]
-
-            if current_time - cached_user.load_time > stale_interval:
-
-                logging.debug(f'Staling cache for user {user_tg_id}')
-
-                if cached_user in self.scheduled_saves:
-                    cached_user.save_context()
-
-                del self.users[user_tg_id]
+            logging.debug(f'Staling cache for user {user_tg_id}')
+            self.remove(cached_user, 'stale')
+            LAST_STALED_USER_CACHE = time.time()
 
-                LAST_STALED_USER_CACHE = time.time()
+        # time until the oldest cached user becomes stale, used by scheduler as the next run delay
+        if self.expiry_heap:
+            return max(min(self.expiry_heap[0][0] - current_time, stale_interval), 0)
+        return stale_interval
 
+    @traced('UsersCache._get_neighbours_from_section', 'pandas')
     def _get_neighbours_from_section(self, building: str, section: str = None) -> DataFrame:
         table = DB[building]
 
@@ -851,14 +1523,196 @@ class UsersCache:
         return neighbours_table
 
     def get_neighbours_from_section(self, building: str, section: str = None) -> Dict[
-        str, Dict[str, Dict[str, Any[str, List[Any[User, List[str]]]]]]]:
+        str, Dict[str, Dict[str, Any[str, List[Any[ResidentView, List[str]]]]]]]:
         neighbours_table = self._get_neighbours_from_section(building, section)
         return rebuild_neighbours_dict_from_table(neighbours_table)
 
 
+USER_BASE_SIZE = 4096
+USER_TABLE_ROW_SIZE = 1024
+
 USERS_CACHE = UsersCache()
 
 
+def normalize_username(username: str) -> str:
+    return username.strip().lstrip('@').lower()
+
+
+class ResidentsIndex:
+    """
+    Hash indexes of residents telegram IDs by telegram ID, phone and username, rebuilt on tables sync
+    """
+
+    def __init__(self):
+        self.buildings: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+    def build(self, building: str) -> None:
+        by_telegram = {}
+        by_phone = {}
+        by_username = {}
+
+        table = DB[building]
+        for telegram_id, phone, username in table[['telegram', 'phone', 'username']].itertuples(index=False):
+            if not telegram_id:
+                continue
+            by_telegram.setdefault(telegram_id, telegram_id)
+            if phone:
+                by_phone.setdefault(phone, telegram_id)
+            if username:
+                by_username.setdefault(normalize_username(username), telegram_id)
+
+        self.buildings[building] = {
+            'telegram': by_telegram,
+            'phone': by_phone,
+            'username': by_username
+        }
+
+    def _find(self, index_name: str, key: str) -> str or None:
+        for building_indexes in self.buildings.values():
+            telegram_id = building_indexes[index_name].get(key)
+            if telegram_id:
+                return telegram_id
+        return None
+
+    def find_by_telegram(self, telegram_id: str or int) -> str or None:
+        return self._find('telegram', str(telegram_id))
+
+    def find_by_phone(self, phone: str) -> str or None:
+        return self._find('phone', phone.replace('+', ''))
+
+    def find_by_username(self, username: str) -> str or None:
+        return self._find('username', normalize_username(username))
+
+    def find_building_by_telegram(self, telegram_id: str or int) -> str or None:
+        for building, building_indexes in self.buildings.items():
+            if str(telegram_id) in building_indexes['telegram']:
+                return building
+        return None
+
+    def find_buildings_by_telegram(self, telegram_id: str or int) -> List[str]:
+        return [building for building, building_indexes in self.buildings.items()
+                if str(telegram_id) in building_indexes['telegram']]
+
+
+RESIDENTS_INDEX = ResidentsIndex()
+
+
+def is_resident(telegram_id: str or int) -> bool:
+    return RESIDENTS_INDEX.find_by_telegram(telegram_id) is not None
+
+
+class EntitiesCache:
+    """
+    LRU cache of telegram client entities resolutions with TTL, persisted to disk to survive restarts. Missing
+    entities are cached for a shorter negative_ttl, the username may be taken soon. Changes are saved by
+    a scheduler job and on shutdown.
+    """
+
+    def __init__(self, filepath: str, max_size: int = 1000, ttl: int = 7 * 24 * 60 * 60,
+                 negative_ttl: int = 60 * 60):
+        self.filepath = filepath
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: OrderedDict[str, List] = OrderedDict()
+        self.changed = False
+
+    def configure(self, max_size: int, ttl: int, negative_ttl: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._shrink()
+
+    def load(self) -> None:
+        if not os.path.isfile(self.filepath):
+            return
+
+        try:
+            with open(self.filepath, 'r', encoding='utf8') as stream:
+                self.entries = OrderedDict(json.load(stream))
+        except Exception:
+            logging.error('!!! Failed to read telegram entities cache !!!')
+            return
+
+        self._shrink()
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        with open(self.filepath, 'w', encoding='utf8') as stream:
+            json.dump(list(self.entries.items()), stream, ensure_ascii=False)
+        self.changed = False
+
+    def save_if_changed(self) -> None:
+        if self.changed:
+            self.save()
+
+    def has(self, query: str) -> bool:
+        entry = self.entries.get(query)
+        if entry is None:
+            return False
+
+        ttl = self.ttl if entry[0] is not None else self.negative_ttl
+        if time.time() - entry[1] > ttl:
+            del self.entries[query]
+            self.changed = True
+            return False
+
+        self.entries.move_to_end(query)
+        return True
+
+    def get(self, query: str) -> int or None:
+        return self.entries[query][0]
+
+    def put(self, query: str, entity_id: int or None) -> None:
+        self.entries[query] = [entity_id, time.time()]
+        self.entries.move_to_end(query)
+        self._shrink()
+        self.changed = True
+
+    def _shrink(self) -> None:
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.changed = True
+
+
+ENTITIES_CACHE = EntitiesCache('./data/entities_cache.json')
+
+
+class RenderCache:
+    """
+    Pre-rendered responses which depend only on tables, keyed by command, building, section and view flags.
+    Invalidated on every tables change and configs reload.
+    """
+
+    def __init__(self):
+        self.generation = TABLES_GENERATION
+        self.entries: Dict[tuple, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self) -> None:
+        self.entries = {}
+        self.generation = TABLES_GENERATION
+
+    def get_or_render(self, key: tuple, render: Callable[[], Any]) -> Any:
+        if self.generation != TABLES_GENERATION:
+            self.invalidate()
+
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        rendered = render()
+        # tables could be synced while rendering, such result is not cached
+        if self.generation == TABLES_GENERATION:
+            self.entries[key] = rendered
+        return rendered
+
+
+RENDER_CACHE = RenderCache()
+
+
 async def _tg_client_observe_groups_for_user(client: TelegramClient, user: User):
     await client.get_dialogs()
     for chat in CONFIGS['buildings']['area_chats'][user.building()]:
@@ -866,14 +1720,18 @@ async def _tg_client_observe_groups_for_user(client: TelegramClient, user: User)
 
 
 async def _tg_client_add_user_to_channel(channel_id: int, user: User) -> None:
-    await TG_CLIENT(InviteToChannelRequest(
+    from telethon.tl.functions.channels import InviteToChannelRequest
+
+    client = await get_telegram_client()
+    await client(InviteToChannelRequest(
         channel_id,
         [user.telegram_id]
     ))
 
 
 async def _tg_client_send_message_to_user(message: str, user: User) -> None:
-    await TG_CLIENT.send_message(user.telegram_id, message)
+    client = await get_telegram_client()
+    await client.send_message(user.telegram_id, message)
 
 
 async def tg_client_add_user_to_channel(channel_id: int, user: User) -> None:
@@ -887,26 +1745,188 @@ async def tg_client_send_invite_to_public_channel(invite_address, user: User) ->
 
 
 async def tg_client_get_invites_for_chats(chats_ids: List[int]) -> List[str]:
-    results = []
-    for chat_id in chats_ids:
-        results.append(await tg_client_get_invite_for_chat(chat_id))
-    return results
+    return list(await asyncio.gather(*[tg_client_get_invite_for_chat(chat_id) for chat_id in chats_ids]))
 
 
 async def tg_client_get_invite_for_chat(chat_id: int) -> str:
+    link = INVITE_LINKS_POOL.take(chat_id)
+    if link is not None:
+        return link
     return await _tg_client_get_invite_for_chat(chat_id)
 
 
 async def _tg_client_get_invite_for_chat(chat_id: int) -> str:
-    result = await TG_CLIENT(ExportChatInviteRequest(
+    from telethon.tl.functions.messages import ExportChatInviteRequest
+
+    client = await get_telegram_client()
+    result = await client(ExportChatInviteRequest(
         peer=chat_id,
-        expire_date=datetime.datetime.utcnow() + datetime.timedelta(days=1),
+        expire_date=datetime.datetime.utcnow() + datetime.timedelta(seconds=INVITE_LINK_TTL),
         usage_limit=1
     ))
 
     return result.link
 
 
+async def _tg_client_revoke_invite_for_chat(chat_id: int, link: str) -> None:
+    from telethon.tl.functions.messages import EditExportedChatInviteRequest
+
+    client = await get_telegram_client()
+    await client(EditExportedChatInviteRequest(peer=chat_id, link=link, revoked=True))
+
+
+INVITE_LINK_TTL = 24 * 60 * 60
+
+
+class InviteLinksPool:
+    """
+    Single use invite links exported in advance for every building chat, so they are handed out without waiting
+    for Telegram client. A link is removed from the pool when handed out and is never handed out twice.
+    Links with less than min_ttl left are dropped, users are promised 24 hours, and revoked since they are still
+    valid. The pool is topped up by a scheduler job one link per run, spreading client requests in time. The job
+    does not start lazy Telegram client, the pool is filled after the client is started by an action.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.size = 3
+        self.min_ttl = 20 * 60 * 60
+        self.refill_interval = 10
+        self.links: Dict[int, List[List]] = {}
+        self.revoking: List[List] = []
+        self.handed_out = 0
+        self.misses = 0
+
+    def configure(self, size: int, min_ttl: int, refill_interval: float) -> None:
+        self.size = size
+        self.min_ttl = min_ttl
+        self.refill_interval = refill_interval
+
+    def load(self) -> None:
+        if not os.path.isfile(self.filepath):
+            return
+
+        try:
+            with open(self.filepath, 'r', encoding='utf8') as stream:
+                data = json.load(stream)
+            self.links = {int(chat_id): links for chat_id, links in data['links'].items()}
+            self.revoking = data['revoking']
+        except Exception:
+            logging.error('!!! Failed to read invite links pool !!!')
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+        with open(self.filepath, 'w', encoding='utf8') as stream:
+            json.dump({'links': self.links, 'revoking': self.revoking}, stream, ensure_ascii=False)
+
+    def _drop_expiring(self, chat_id: int) -> List[List]:
+        links = []
+        for link in self.links.get(chat_id, []):
+            if link[1] - time.time() >= self.min_ttl:
+                links.append(link)
+            elif link[1] > time.time():
+                self.revoking.append([chat_id, link[0]])
+        self.links[chat_id] = links
+        return links
+
+    def take(self, chat_id: int) -> str or None:
+        links = self._drop_expiring(chat_id)
+        if not links:
+            self.misses += 1
+            SCHEDULER.schedule_job('invite_links_pool', 0, only_earlier=True)
+            return None
+
+        link, _ = links.pop(0)
+        self.handed_out += 1
+        # stored at once, the link must not be handed out again after a restart
+        self.save()
+        SCHEDULER.schedule_job('invite_links_pool', 0, only_earlier=True)
+        return link
+
+    async def refill(self) -> float or None:
+        """
+        Revokes one dropped link or exports one link for the chat with the smallest pool, returns delay until
+        the next refill
+        """
+        from telethon.errors import FloodWaitError
+
+        if TG_CLIENT is None:
+            # lazy client is not started for the pool
+            return self.refill_interval * 6
+
+        chats_ids = get_invite_chats_ids()
+        for chat_id in list(self.links.keys()):
+            if chat_id not in chats_ids:
+                self.revoking.extend([chat_id, link] for link, _ in self.links.pop(chat_id))
+
+        if chats_ids:
+            chat_id = min(chats_ids, key=lambda c: len(self._drop_expiring(c)))
+        if self.revoking:
+            revoked_chat_id, link = self.revoking[0]
+            try:
+                await _tg_client_revoke_invite_for_chat(revoked_chat_id, link)
+            except FloodWaitError as e:
+                logging.error(f'Telegram client flood limit reached on invite links, wait for {e.seconds} sec.')
+                return e.seconds
+            except Exception:
+                # e.g. the bot is not an admin of the chat anymore, the link is not retried
+                logging.error(f'Failed to revoke invite link for {revoked_chat_id}:\n{traceback.format_exc()}')
+            self.revoking.pop(0)
+            self.save()
+            return self.refill_interval
+
+        if not chats_ids:
+            return None
+
+        if len(self.links[chat_id]) >= self.size:
+            # the nearest link to become too old for handing out
+            oldest = min(link[1] for links in self.links.values() for link in links)
+            return max(oldest - self.min_ttl - time.time(), self.refill_interval)
+
+        try:
+            link = await _tg_client_get_invite_for_chat(chat_id)
+        except FloodWaitError as e:
+            logging.error(f'Telegram client flood limit reached on invite links, wait for {e.seconds} sec.')
+            return e.seconds
+        except Exception:
+            logging.error(f'Failed to export invite link for {chat_id}:\n{traceback.format_exc()}')
+            return self.refill_interval * 6
+
+        self.links[chat_id].append([link, time.time() + INVITE_LINK_TTL])
+        self.save()
+        return self.refill_interval
+
+    def get_stats(self) -> Dict:
+        return {
+            'links': sum(len(links) for links in self.links.values()),
+            'chats': len(self.links),
+            'revoking': len(self.revoking),
+            'handed_out': self.handed_out,
+            'misses': self.misses
+        }
+
+
+INVITE_LINKS_POOL = InviteLinksPool('./data/invite_links.json')
+
+
+async def tg_bot_delete_messages(chat_id: int, messages_ids: List[int]) -> None:
+    # Telegram allows deleting up to 100 messages of the same chat at once
+    for i in range(0, len(messages_ids), TG_DELETE_MESSAGES_BATCH_SIZE):
+        batch = messages_ids[i:i + TG_DELETE_MESSAGES_BATCH_SIZE]
+        logging.debug(f'Deleting messages {batch} from {chat_id}...')
+        try:
+            await TG_BOT.delete_messages(chat_id=chat_id, message_ids=batch)
+            continue
+        except Exception:
+            logging.debug(f'Failed to delete messages batch from {chat_id}, deleting one by one...')
+
+        for message_id in batch:
+            try:
+                await TG_BOT.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logging.error(f'Failed to delete message {message_id} from {chat_id}: {e}')
+
+
 async def tg_bot_delete_user_from_channel(channel_id: int, user_id: int) -> None:
     await TG_BOT.ban_chat_member(chat_id=channel_id, user_id=user_id)
     await TG_BOT.unban_chat_member(chat_id=channel_id, user_id=user_id)
@@ -914,22 +1934,40 @@ async def tg_bot_delete_user_from_channel(channel_id: int, user_id: int) -> None
 
 async def _tg_client_get_entity_id(entity_query: int or str) -> int or None:
     try:
-        entity = await TG_CLIENT.get_entity(entity_query)
+        client = await get_telegram_client()
+        entity = await client.get_entity(entity_query)
         if entity and entity.id:
             return entity.id
     except ValueError:
         return None
 
 
+async def tg_client_get_entity_id(entity_query: str) -> int or None:
+    from telethon.errors import FloodWaitError
+
+    cache_key = normalize_username(entity_query)
+    if ENTITIES_CACHE.has(cache_key):
+        return ENTITIES_CACHE.get(cache_key)
+
+    try:
+        entity_id = await _tg_client_get_entity_id(entity_query)
+    except FloodWaitError as e:
+        logging.error(f'Telegram client flood limit reached, wait for {e.seconds} sec.')
+        return None
+
+    ENTITIES_CACHE.put(cache_key, entity_id)
+    return entity_id
+
+
 async def tg_client_get_user_by_username(username: str) -> User or None:
-    user_id = await _tg_client_get_entity_id(username)
+    user_id = await tg_client_get_entity_id(username)
     if not user_id:
         return None
     return USERS_CACHE.get_user(user_id)
 
 
 async def tg_client_get_user_id_by_phone(phone: str) -> int or None:
-    result = await _tg_client_get_entity_id(phone)
+    result = await tg_client_get_entity_id(phone)
     if result is not None:
         return result
 
@@ -963,16 +2001,70 @@ async def reload_configs():
         DB[building_name] = None
         with open('./buildings/' + building_file, 'r') as s:
             CONFIGS['buildings'][building_name] = json.load(s)
+    # responses are rendered with buildings settings too, e.g. objects amounts and groups
+    RENDER_CACHE.invalidate()
 
     for stats_file in os.listdir('./stats'):
         stats_name = stats_file.split('.')[0]
         with open('./stats/' + stats_file, 'r') as s:
             STATS[stats_name] = json.load(s)
 
+    global GARBAGE_CLASSIFIER, GARBAGE_CLEANING_CONFIGS
+    if 'GARBAGE_CLASSIFIER' not in globals():
+        GARBAGE_CLASSIFIER = GarbageClassifier()
+    GARBAGE_CLEANING_CONFIGS = build_garbage_cleaning_configs()
 
-async def connect_google_service():
+    load_calendar_jobs_last_runs()
+
+    invite_links_config = CONFIGS['service'].get('invite_links_pool', {})
+    INVITE_LINKS_POOL.configure(invite_links_config.get('size', 3),
+                                invite_links_config.get('min_ttl', 20 * 60 * 60),
+                                invite_links_config.get('refill_interval', 10))
+    INVITE_LINKS_POOL.load()
+
+    entities_cache_config = CONFIGS['service'].get('entities_cache', {})
+    ENTITIES_CACHE.configure(entities_cache_config.get('max_size', 1000),
+                             entities_cache_config.get('ttl', 7 * 24 * 60 * 60),
+                             entities_cache_config.get('negative_ttl', 60 * 60))
+    # configs are reloaded at runtime too, not saved entries would be lost by the load
+    ENTITIES_CACHE.save_if_changed()
+    ENTITIES_CACHE.load()
+
+    watchdog_config = CONFIGS['service'].get('loop_watchdog', {})
+    LOOP_WATCHDOG.configure(watchdog_config.get('threshold', 1.0),
+                            watchdog_config.get('interval', 0.1),
+                            watchdog_config.get('report_interval', 600))
+
+    write_back_config = CONFIGS['service'].get('tables_write_back', {})
+    TABLES_WRITE_BACK.configure(write_back_config.get('delay', 5),
+                                write_back_config.get('max_attempts', 5))
+
+    users_cache_config = CONFIGS['service'].get('users_cache', {})
+    USERS_CACHE.configure(users_cache_config.get('max_size', 1000),
+                          users_cache_config.get('max_memory_mb', 64) * 1024 * 1024)
+
+    profiler_config = CONFIGS['service'].get('profiler', {})
+    SAMPLING_PROFILER.configure(profiler_config.get('interval', 0.005),
+                                profiler_config.get('top', 15))
+
+    tracing_config = CONFIGS['service'].get('tracing', {})
+    TRACER.configure(tracing_config.get('enabled', False),
+                     tracing_config.get('filepath', './data/traces.jsonl'),
+                     tracing_config.get('max_bytes', 10 * 1024 * 1024),
+                     tracing_config.get('backups', 3))
+
+
+def build(service_name: str, version: str, **kwargs):
+    from googleapiclient.discovery import build as build_google_service
+
+    return build_google_service(service_name, version, **kwargs)
+
+
+def load_google_credentials():
     global GOOGLE_CREDENTIALS
 
+    from google.oauth2 import service_account
+
     filename = CONFIGS['service']['identity']['google']['filename']
     scopes = CONFIGS['service']['identity']['google']['scopes']
 
@@ -980,8 +2072,41 @@ async def connect_google_service():
         service_account.Credentials.from_service_account_file(filename, scopes=scopes)
 
 
+async def connect_google_service():
+    await asyncio.to_thread(load_google_credentials)
+
+
+def build_people_indexes(building_number: str):
+    BUILDINGS_DIRECTORY[building_number] = build_building_directory(building_number)
+    RESIDENTS_INDEX.build(building_number)
+    RESIDENTS_VIEWS[building_number] = build_residents_views(building_number)
+
+
+def bump_tables_generation(building_number: str):
+    global TABLES_GENERATION
+
+    TABLES_GENERATION += 1
+    TABLES_GENERATIONS[building_number] = TABLES_GENERATION
+    RENDER_CACHE.invalidate()
+
+
+def get_tables_generations(telegram_id: str or int) -> Dict[str, int]:
+    # only tables of the resident buildings are compared, changes of other buildings do not affect the resident
+    return {building: TABLES_GENERATIONS.get(building, 0)
+            for building in RESIDENTS_INDEX.find_buildings_by_telegram(telegram_id)}
+
+
+def rebuild_people_tables(building_number: str):
+    build_people_indexes(building_number)
+    if PARKING_CLEANING_DB.get(building_number) is not None:
+        PARKING_CLEANING_ROSTER[building_number] = build_parking_cleaning_roster(building_number)
+    bump_tables_generation(building_number)
+
+
+@traced('reload_tables', 'tables')
 def reload_tables():
     global TABLES_RELOADED_TIME
+    from googleapiclient.errors import HttpError
 
     if time.time() - TABLES_RELOADED_TIME < 10:
         return
@@ -994,45 +2119,73 @@ def reload_tables():
         for building_number, building_table in DB.items():
 
             # PEOPLE
+            sheet_started = time.perf_counter()
             spreadsheet_id = CONFIGS['buildings'][building_number]['spreadsheet']['people']['id']
             spreadsheet_range = CONFIGS['buildings'][building_number]['spreadsheet']['people']['range']
 
             sheet = service.spreadsheets()
-            result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                        range=spreadsheet_range).execute()
+            with trace_span('sheets_get', 'tables', building=building_number, sheet='people'):
+                result = sheet.values().get(spreadsheetId=spreadsheet_id,
+                                            range=spreadsheet_range).execute()
             rows = result.get('values', [])
 
             if not rows:
                 logging.error('Syncing tables error PEOPLE: No data')
                 return
 
-            DB[building_number] = pd.DataFrame(rows, columns=DF_COLUMNS).map(
-                lambda x: x.strip() if isinstance(x, str) else x)
-            DB[building_number]['user_type'] = DB[building_number]['user_type'].str.lower()
+            # tables and everything built from them are recalculated only when sheets were changed
+            is_people_changed = TABLES_SOURCES.get((building_number, 'people')) != rows
+            if is_people_changed:
+                with trace_span('build_people_tables', 'pandas', building=building_number, rows=len(rows)):
+                    DB[building_number] = pd.DataFrame(rows, columns=DF_COLUMNS).map(
+                        lambda x: x.strip() if isinstance(x, str) else x)
+                    DB[building_number]['user_type'] = DB[building_number]['user_type'].str.lower()
+                    # edits not flushed yet should stay visible
+                    TABLES_WRITE_BACK.apply_pending(building_number)
+                    build_people_indexes(building_number)
+                    TABLES_WRITE_BACK.changed_buildings.discard(building_number)
+                TABLES_SOURCES[(building_number, 'people')] = rows
+
+            METRICS.observe('tables_sync_duration_seconds', time.perf_counter() - sheet_started,
+                            building=building_number, sheet='people')
 
             # PARKING CLEANING
+            sheet_started = time.perf_counter()
             spreadsheet_id = CONFIGS['buildings'][building_number]['spreadsheet']['parking_cleaning']['id']
             spreadsheet_range = CONFIGS['buildings'][building_number]['spreadsheet']['parking_cleaning']['range']
 
             sheet = service.spreadsheets()
-            result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                        range=spreadsheet_range).execute()
+            with trace_span('sheets_get', 'tables', building=building_number, sheet='parking_cleaning'):
+                result = sheet.values().get(spreadsheetId=spreadsheet_id,
+                                            range=spreadsheet_range).execute()
             rows = result.get('values', [])
 
             if not rows:
                 logging.error('Syncing tables error PARKING CLEANING: No data')
                 return
 
-            PARKING_CLEANING_DB[building_number] = pd.DataFrame(rows, columns=['date', 'places']).map(
-                lambda x: x.strip() if isinstance(x, str) else x)
+            is_parking_cleaning_changed = TABLES_SOURCES.get((building_number, 'parking_cleaning')) != rows
+            if is_parking_cleaning_changed:
+                PARKING_CLEANING_DB[building_number] = pd.DataFrame(rows, columns=['date', 'places']).map(
+                    lambda x: x.strip() if isinstance(x, str) else x)
+                TABLES_SOURCES[(building_number, 'parking_cleaning')] = rows
+
+            if is_people_changed or is_parking_cleaning_changed:
+                PARKING_CLEANING_ROSTER[building_number] = build_parking_cleaning_roster(building_number)
+                bump_tables_generation(building_number)
+
+            METRICS.observe('tables_sync_duration_seconds', time.perf_counter() - sheet_started,
+                            building=building_number, sheet='parking_cleaning')
 
             # ASSISTANT
+            sheet_started = time.perf_counter()
             spreadsheet_id = CONFIGS['buildings'][building_number]['spreadsheet']['assistant']['id']
             spreadsheet_range = CONFIGS['buildings'][building_number]['spreadsheet']['assistant']['range']
 
             sheet = service.spreadsheets()
-            result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                        range=spreadsheet_range).execute()
+            with trace_span('sheets_get', 'tables', building=building_number, sheet='assistant'):
+                result = sheet.values().get(spreadsheetId=spreadsheet_id,
+                                            range=spreadsheet_range).execute()
             rows = result.get('values', [])
 
             if not rows:
@@ -1042,6 +2195,9 @@ def reload_tables():
             global HELP_ASSISTANT
             HELP_ASSISTANT = HelpAssistant(rows)
 
+            METRICS.observe('tables_sync_duration_seconds', time.perf_counter() - sheet_started,
+                            building=building_number, sheet='assistant')
+
             logging.debug(f'  {building_number} synced')
 
         TABLES_RELOADED_TIME = time.time()
@@ -1050,8 +2206,238 @@ def reload_tables():
         logging.error(err)
 
 
-def update_table(building: str or int, values: List[List[str, str or int]]):
-    pass
+def parse_sheet_range(spreadsheet_range: str) -> (str, int, int):
+    """
+    Splits A1 notation range like "'Sheet'!B3:AC" into sheet prefix, index of the first column and first row number
+    """
+    sheet_prefix = ''
+    cells = spreadsheet_range
+    if '!' in spreadsheet_range:
+        sheet_name, cells = spreadsheet_range.rsplit('!', 1)
+        sheet_prefix = sheet_name + '!'
+
+    start = cells.split(':')[0]
+    column_letters = ''.join(c for c in start if c.isalpha()).upper()
+    row_digits = ''.join(c for c in start if c.isdigit())
+
+    column_index = 0
+    for letter in column_letters:
+        column_index = column_index * 26 + ord(letter) - ord('A') + 1
+
+    return sheet_prefix, max(column_index - 1, 0), int(row_digits) if row_digits else 1
+
+
+def get_sheet_column_letters(column_index: int) -> str:
+    letters = ''
+    column_index += 1
+    while column_index:
+        column_index, remainder = divmod(column_index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def format_table_value(value: str or int or bool or None) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'YES' if value else 'NO'
+    return str(value).strip()
+
+
+def normalize_table_value(column_name: str, value: str or None) -> str:
+    value = (value or '').strip()
+    if column_name == 'user_type':
+        value = value.lower()
+    return value
+
+
+class TablesWriteBack:
+    """
+    Queue of people tables cells updates.
+
+    Updates are applied to DB at once and flushed to sheets with one values.batchUpdate per spreadsheet, repeated
+    edits of the same resident cell are coalesced into the last one. Before the write the rows are re-read from the
+    sheet and a cell changed manually since the edit is kept as is. Indexes built from the tables are rebuilt once
+    per flush, the edited user is reloaded from DB at once.
+    """
+
+    def __init__(self):
+        # building -> (telegram_id, column_name) -> {'value', 'expected'}
+        self.pending: Dict[str, Dict[(str, str), Dict]] = {}
+        # updates being written now, a sync meanwhile reads the sheet without them
+        self.in_flight: Dict[str, Dict[(str, str), Dict]] = {}
+        self.attempts: Dict[str, int] = {}
+        # buildings changed since the last rebuild of people tables
+        self.changed_buildings: set[str] = set()
+        self.delay = 5
+        self.max_attempts = 5
+        self.written_cells = 0
+        self.conflicts = 0
+        self.failures = 0
+
+    def configure(self, delay: float, max_attempts: int) -> None:
+        self.delay = delay
+        self.max_attempts = max_attempts
+
+    def get_pending_count(self) -> int:
+        return sum(len(pending) for pending in self.pending.values())
+
+    def enqueue(self, building: str or int, telegram_id: str or int, values: List[List[str, str or int]]) -> None:
+        building = str(building)
+        telegram_id = str(telegram_id)
+        table = DB.get(building)
+        if table is None:
+            logging.error(f'Table {building} is not loaded, update of {telegram_id} skipped')
+            return
+
+        user_rows = table['telegram'] == telegram_id
+        pending = self.pending.setdefault(building, {})
+        for column_name, value in values:
+            if column_name not in DF_COLUMNS:
+                logging.error(f'Unknown table column "{column_name}", update of {telegram_id} skipped')
+                continue
+
+            update = pending.get((telegram_id, column_name))
+            if update is None:
+                update = {
+                    'expected': {normalize_table_value(column_name, v) for v in table.loc[user_rows, column_name]}
+                }
+                pending[(telegram_id, column_name)] = update
+            update['value'] = format_table_value(value)
+
+        self.apply_pending(building)
+        self.changed_buildings.add(building)
+
+        SCHEDULER.schedule_job('tables_write_back', self.delay, only_earlier=True)
+
+    def apply_pending(self, building: str) -> None:
+        table = DB.get(building)
+        if table is None:
+            return
+
+        # newer pending updates are applied after the ones being written
+        for pending in (self.in_flight.get(building, {}), self.pending.get(building, {})):
+            for (telegram_id, column_name), update in pending.items():
+                table.loc[table['telegram'] == telegram_id, column_name] = update['value']
+
+    def rebuild_changed_tables(self) -> None:
+        changed_buildings, self.changed_buildings = self.changed_buildings, set()
+        for building in changed_buildings:
+            rebuild_people_tables(building)
+
+    async def flush(self) -> float or None:
+        self.rebuild_changed_tables()
+        if not self.pending:
+            return None
+
+        if GOOGLE_CREDENTIALS is None:
+            return self.delay
+
+        retry_delay = None
+        for building in list(self.pending.keys()):
+            # sheets requests run in a thread, edits made meanwhile are queued separately
+            pending = self.pending.pop(building)
+            self.in_flight[building] = pending
+            try:
+                written, conflicts = await asyncio.to_thread(self.flush_building, building, pending)
+            except asyncio.CancelledError:
+                # the thread may still write them, written cells are skipped by the next flush
+                self._requeue(building, pending)
+                raise
+            except Exception as err:
+                self.failures += 1
+                attempts = self.attempts.get(building, 0) + 1
+                if attempts < self.max_attempts:
+                    logging.error(f'Tables write back to {building} failed ({attempts}/{self.max_attempts}): {err}')
+                    self.attempts[building] = attempts
+                    self._requeue(building, pending)
+                    delay = self.delay * 2 ** attempts
+                    retry_delay = delay if retry_delay is None else min(retry_delay, delay)
+                    continue
+
+                logging.error(f'Tables write back to {building} failed, {len(pending)} updates dropped: {err}')
+                # optimistic changes are replaced with actual sheet values on the next sync
+                TABLES_SOURCES.pop((building, 'people'), None)
+            else:
+                self.written_cells += written
+                self.conflicts += conflicts
+                if conflicts:
+                    # manual values are loaded on the next sync
+                    TABLES_SOURCES.pop((building, 'people'), None)
+            finally:
+                self.in_flight.pop(building, None)
+
+            self.attempts.pop(building, None)
+
+        if self.pending and retry_delay is None:
+            retry_delay = self.delay
+        return retry_delay
+
+    def _requeue(self, building: str, pending: Dict[(str, str), Dict]) -> None:
+        newer = self.pending.setdefault(building, {})
+        for key, update in pending.items():
+            if key in newer:
+                # the sheet still has the value expected by the failed update
+                newer[key]['expected'] |= update['expected']
+            else:
+                newer[key] = update
+
+    def flush_building(self, building: str, pending: Dict[(str, str), Dict]) -> (int, int):
+        """
+        Runs in a thread and does not change shared state, returns amounts of written cells and conflicts
+        """
+        service = build('sheets', 'v4', credentials=GOOGLE_CREDENTIALS, cache_discovery=False)
+
+        spreadsheet_id = CONFIGS['buildings'][building]['spreadsheet']['people']['id']
+        spreadsheet_range = CONFIGS['buildings'][building]['spreadsheet']['people']['range']
+        sheet_prefix, first_column, first_row = parse_sheet_range(spreadsheet_range)
+
+        sheet = service.spreadsheets()
+        result = sheet.values().get(spreadsheetId=spreadsheet_id,
+                                    range=spreadsheet_range).execute()
+        rows = result.get('values', [])
+
+        # rows could be moved by manual edits since the last sync, so they are found by telegram ID again
+        telegram_column = DF_COLUMNS.index('telegram')
+        rows_by_telegram = {}
+        for row_index, row in enumerate(rows):
+            if len(row) > telegram_column and row[telegram_column].strip():
+                rows_by_telegram.setdefault(row[telegram_column].strip(), []).append(row_index)
+
+        data = []
+        conflicts = 0
+        for (telegram_id, column_name), update in pending.items():
+            column = DF_COLUMNS.index(column_name)
+            for row_index in rows_by_telegram.get(telegram_id, []):
+                row = rows[row_index]
+                current_value = normalize_table_value(column_name, row[column] if len(row) > column else '')
+                if current_value == normalize_table_value(column_name, update['value']):
+                    continue
+
+                if current_value not in update['expected']:
+                    logging.error(f'Cell "{column_name}" of {telegram_id} in table {building} was changed manually '
+                                  f'to "{current_value}", "{update["value"]}" is not written')
+                    conflicts += 1
+                    continue
+
+                data.append({
+                    'range': f'{sheet_prefix}{get_sheet_column_letters(first_column + column)}{first_row + row_index}',
+                    'values': [[update['value']]]
+                })
+
+        if data:
+            sheet.values().batchUpdate(spreadsheetId=spreadsheet_id,
+                                       body={'valueInputOption': 'RAW', 'data': data}).execute()
+            logging.debug(f'Written {len(data)} cells to table {building}')
+
+        return len(data), conflicts
+
+
+TABLES_WRITE_BACK = TablesWriteBack()
+
+
+def update_table(building: str or int, telegram_id: str or int, values: List[List[str, str or int]]):
+    TABLES_WRITE_BACK.enqueue(building, telegram_id, values)
 
 
 def identify_chat_by_tg_update(update: Update) -> (bool, str, bool, str, list or None):
@@ -1079,50 +2465,711 @@ def identify_chat_by_tg_update(update: Update) -> (bool, str, bool, str, list or
                 if group.get('section'):
                     chat_section = group['section']
 
-                if group['name'] == 'admin':
-                    is_admin_chat = True
+                if group['name'] == 'admin':
+                    is_admin_chat = True
+
+                break
+
+    return is_found, found_building_number, is_admin_chat, chat_name, chat_section, building_chats
+
+
+class ScheduledJob:
+    def __init__(self, name: str, callback, interval: float or None = None, one_shot: bool = False):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.one_shot = one_shot
+        self.deadline: float or None = None
+        self.is_running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_run_time = None
+
+
+class Scheduler:
+    """
+    Single loop owning all periodic and one-shot jobs.
+
+    Pending deadlines are kept in a heap, the loop sleeps until the nearest one or until it is woken up by
+    a job reschedule. A job callback may return a number of seconds to override its next run delay, or None
+    for a job without interval to park it until it is scheduled again. One-shot jobs are dropped after the run.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self.heap: List[tuple] = []
+        self.sequence = 0
+        self.wakeup: asyncio.Event or None = None
+        self.task: Task or None = None
+        # the loop keeps references to running jobs, otherwise they could be garbage collected
+        self.running_tasks: set[Task] = set()
+
+    def has_job(self, name: str) -> bool:
+        return name in self.jobs
+
+    def add_job(self, name: str, callback, interval: float or None = None, delay: float = 0,
+                one_shot: bool = False) -> ScheduledJob:
+        job = self.jobs.get(name)
+        if job is None:
+            job = ScheduledJob(name, callback, interval, one_shot)
+            self.jobs[name] = job
+            self.schedule_job(name, delay)
+        return job
+
+    def remove_job(self, name: str) -> None:
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.deadline = None
+
+    def schedule_job(self, name: str, delay: float, only_earlier: bool = False) -> None:
+        job = self.jobs.get(name)
+        if job is None:
+            return
+
+        deadline = time.monotonic() + max(delay, 0)
+        if only_earlier and job.deadline is not None and job.deadline <= deadline:
+            return
+
+        job.deadline = deadline
+        if not job.is_running:
+            self._push(job)
+
+    def _push(self, job: ScheduledJob) -> None:
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.deadline, self.sequence, job))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self) -> None:
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._loop())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def wait_running_jobs(self, timeout: float) -> bool:
+        """
+        Waits for jobs started before stop(), the ones not finished until the timeout are cancelled
+        """
+        if not self.running_tasks:
+            return True
+
+        _, pending = await asyncio.wait(set(self.running_tasks), timeout=timeout)
+        for task in pending:
+            logging.warning(f'Scheduled job "{task.get_name()}" was not finished in {timeout} sec., cancelled')
+            task.cancel()
+        return not pending
+
+    async def _loop(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, job = heapq.heappop(self.heap)
+                # entries of removed or rescheduled jobs are dropped lazily
+                if self.jobs.get(job.name) is not job or job.deadline != deadline or job.is_running:
+                    continue
+                job.is_running = True
+                task = asyncio.create_task(self._run_job(job, now - deadline), name=job.name)
+                self.running_tasks.add(task)
+                task.add_done_callback(self.running_tasks.discard)
+
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job: ScheduledJob, lag: float):
+        job.deadline = None
+        job.last_lag = lag
+        job.max_lag = max(job.max_lag, lag)
+        started = time.monotonic()
+        next_delay = None
+
+        try:
+            result = job.callback()
+            if asyncio.iscoroutine(result):
+                result = await result
+            if isinstance(result, (int, float)):
+                next_delay = result
+        except Exception:
+            job.failures += 1
+            logging.error(f'Scheduled job "{job.name}" failed:\n{traceback.format_exc()}')
+
+        job.last_duration = time.monotonic() - started
+        job.total_duration += job.last_duration
+        job.runs += 1
+        job.last_run_time = time.time()
+        job.is_running = False
+
+        if self.jobs.get(job.name) is not job:
+            return
+
+        if job.deadline is not None:
+            # job was rescheduled while running
+            self._push(job)
+        elif next_delay is not None:
+            self.schedule_job(job.name, next_delay)
+        elif job.interval is not None:
+            self.schedule_job(job.name, job.interval)
+        elif job.one_shot:
+            del self.jobs[job.name]
+
+    def get_stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        stats = {}
+        for name, job in self.jobs.items():
+            stats[name] = {
+                'runs': job.runs,
+                'failures': job.failures,
+                'last_duration': job.last_duration,
+                'avg_duration': job.total_duration / job.runs if job.runs else 0.0,
+                'last_lag': job.last_lag,
+                'max_lag': job.max_lag,
+                'next_run_in': job.deadline - now if job.deadline is not None else None
+            }
+        return stats
+
+
+SCHEDULER = Scheduler()
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag with a heartbeat task. A helper thread notices a missing heartbeat while the loop is
+    still blocked and captures the loop thread stack, so the blocking call can be found. Stalls are counted per
+    bot function and reported to admin chats, the same function is reported not more often than report_interval.
+    """
+
+    def __init__(self):
+        self.threshold = 1.0
+        self.interval = 0.1
+        self.report_interval = 600
+        self.task: Task or None = None
+        self.thread: threading.Thread or None = None
+        self.stop_event = threading.Event()
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.captured_beat = None
+        self.captured_stack: List[traceback.FrameSummary] or None = None
+        self.stalls: Dict[str, int] = {}
+        self.max_lag = 0.0
+        self.last_reports: Dict[str, float] = {}
+
+    def configure(self, threshold: float, interval: float, report_interval: float) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stop_event.clear()
+        self.task = asyncio.create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.stop_event.set()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+
+            lag = max(now - expected, 0.0)
+            METRICS.observe('event_loop_lag_seconds', lag)
+            if lag >= self.threshold:
+                self._proceed_stall(lag)
+
+    def _watch(self):
+        # runs in helper thread, the stack is taken while the loop thread is still inside the blocking call
+        while not self.stop_event.wait(self.interval):
+            last_beat = self.last_beat
+            if time.monotonic() - last_beat < self.threshold or self.captured_beat == last_beat:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.captured_stack = traceback.extract_stack(frame)
+                self.captured_beat = last_beat
+
+    def _proceed_stall(self, lag: float) -> None:
+        stack = self.captured_stack
+        self.captured_stack = None
+
+        function = get_blocking_function_name(stack) if stack else 'неизвестно'
+        self.stalls[function] = self.stalls.get(function, 0) + 1
+        self.max_lag = max(self.max_lag, lag)
+        METRICS.inc('event_loop_stalls_total', function=function)
+        logging.warning(f'Event loop was blocked for {lag:.2f} sec. in {function}')
+
+        now = time.monotonic()
+        if now - self.last_reports.get(function, -self.report_interval) < self.report_interval:
+            return
+        self.last_reports[function] = now
+
+        text = f'Цикл событий был заблокирован на {lag * 1000:.0f} мс в {function}, ' \
+               f'всего блокировок здесь: {self.stalls[function]}'
+        if stack:
+            text += '\n\n' + ''.join(traceback.format_list(stack[-10:]))
+        asyncio.create_task(send_message_to_admin_chats(text[:TG_MESSAGE_MAX_LENGTH]))
+
+    def get_stats(self) -> Dict:
+        return {
+            'stalls': sum(self.stalls.values()),
+            'max_lag': self.max_lag,
+            'top_functions': sorted(self.stalls.items(), key=lambda item: item[1], reverse=True)[:3]
+        }
+
+
+def get_blocking_function_name(stack: List[traceback.FrameSummary]) -> str:
+    # the deepest bot frame is the one to fix, library frames below it only show what exactly blocked
+    bot_directory = os.path.dirname(os.path.abspath(__file__))
+    for frame in reversed(stack):
+        if os.path.dirname(os.path.abspath(frame.filename)) == bot_directory:
+            return f'{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})'
+    frame = stack[-1]
+    return f'{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})'
+
+
+async def send_message_to_admin_chats(text: str) -> None:
+    if 'TG_BOT' not in globals():
+        return
+
+    for chat_id in get_admin_chats_ids():
+        try:
+            await TG_BOT.send_message(chat_id=chat_id, text=text)
+        except Exception:
+            logging.error(f'Failed to send message to admin chat {chat_id}:\n{traceback.format_exc()}')
+
+
+LOOP_WATCHDOG = LoopWatchdog()
+
+
+class SamplingProfiler:
+    """
+    Samples the event loop thread stack from a helper thread and aggregates collapsed stacks, the output is
+    compatible with flamegraph.pl and speedscope. Samples where the loop waits for events are counted as idle: the
+    selector call for asyncio loop, for uvloop the wait is in C code and only the frames which run the loop remain.
+    """
+
+    def __init__(self):
+        self.interval = 0.005
+        self.top = 15
+        self.thread: threading.Thread or None = None
+        self.stop_event = threading.Event()
+        self.loop_thread_id = None
+        self.loop_driver_codes = set()
+        self.finish_task: Task or None = None
+        self.chat_id = None
+        self.started = 0.0
+        self.stacks: Dict[str, int] = {}
+        self.idle_stacks = set()
+        self.samples = 0
+        self.idle_samples = 0
+
+    def configure(self, interval: float, top: int) -> None:
+        self.interval = interval
+        self.top = top
+
+    def is_running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, duration: float, chat_id: int) -> bool:
+        if self.is_running():
+            return False
+
+        self.chat_id = chat_id
+        self.started = time.monotonic()
+        self.stacks = {}
+        self.idle_stacks = set()
+        self.samples = 0
+        self.idle_samples = 0
+        self.loop_thread_id = threading.get_ident()
+        self.loop_driver_codes = self._get_loop_driver_codes()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        self.finish_task = asyncio.create_task(self._finish_later(duration))
+        return True
+
+    async def stop(self) -> bool:
+        if not self.is_running():
+            return False
+
+        self.finish_task.cancel()
+        await self._finish()
+        return True
+
+    async def _finish_later(self, duration: float):
+        await asyncio.sleep(duration)
+        await self._finish()
+
+    async def _finish(self):
+        self.stop_event.set()
+        await asyncio.to_thread(self.thread.join, self.interval * 10)
+        self.thread = None
+        self.finish_task = None
+
+        duration = time.monotonic() - self.started
+        logging.info(f'Profiler stopped after {duration:.1f} sec., {self.samples} samples')
+
+        try:
+            await TG_BOT.send_message(chat_id=self.chat_id,
+                                      text=self.get_report_str(duration)[:TG_MESSAGE_MAX_LENGTH])
+            await TG_BOT.send_document(chat_id=self.chat_id,
+                                       document=self.get_collapsed_stacks().encode('utf8'),
+                                       filename=f'profile_{datetime.datetime.now():%Y%m%d_%H%M%S}.collapsed.txt',
+                                       caption='Стеки для flamegraph.pl или speedscope.app')
+        except Exception:
+            logging.error(f'Failed to send profile:\n{traceback.format_exc()}')
+
+    def _sample(self):
+        # runs in helper thread, the loop thread is never paused
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+
+            is_idle = os.path.basename(frame.f_code.co_filename) == 'selectors.py' or \
+                frame.f_code in self.loop_driver_codes
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            del frame
+
+            collapsed = ';'.join(reversed(stack))
+            self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+            self.samples += 1
+            if is_idle:
+                self.idle_stacks.add(collapsed)
+                self.idle_samples += 1
+
+    @staticmethod
+    def _get_loop_driver_codes() -> set:
+        """
+        Called from a coroutine: the frames outside the outermost coroutine are the ones running the loop. They are
+        needed for uvloop only, asyncio loop frames are also seen while it runs callbacks.
+        """
+        codes = set()
+        if isinstance(asyncio.get_running_loop(), asyncio.BaseEventLoop):
+            return codes
+        frame = sys._getframe()
+        while frame is not None and not frame.f_code.co_flags & inspect.CO_COROUTINE:
+            frame = frame.f_back
+        while frame is not None:
+            if not frame.f_code.co_flags & inspect.CO_COROUTINE:
+                codes.add(frame.f_code)
+            frame = frame.f_back
+        return codes
+
+    def get_collapsed_stacks(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.items())
+
+    def get_hottest_functions(self) -> (List[tuple], List[tuple]):
+        """
+        Returns functions by own samples and bot functions by samples including their callees, idle samples excluded
+        """
+        bot_directory = os.path.dirname(os.path.abspath(__file__))
+        bot_files = {os.path.basename(f) for f in os.listdir(bot_directory) if f.endswith('.py')}
+
+        own = {}
+        total = {}
+        for collapsed, count in self.stacks.items():
+            if collapsed in self.idle_stacks:
+                continue
+            frames = collapsed.split(';')
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                if frame.rsplit(' (', 1)[-1].split(':')[0] in bot_files:
+                    total[frame] = total.get(frame, 0) + count
+
+        def top(counters):
+            return sorted(counters.items(), key=lambda item: item[1], reverse=True)[:self.top]
+        return top(own), top(total)
+
+    def get_report_str(self, duration: float) -> str:
+        samples = max(self.samples, 1)
+        text = f'Профилирование {duration:.0f} сек., сэмплов: {self.samples}, ' \
+               f'простой цикла событий: {self.idle_samples / samples * 100:.0f}%\n'
+
+        own, total = self.get_hottest_functions()
+        text += '\nСамые горячие функции (собственное время):\n'
+        for function, count in own:
+            text += f'{count / samples * 100:.1f}% {function}\n'
+        text += '\nФункции бота (включая вызовы):\n'
+        for function, count in total:
+            text += f'{count / samples * 100:.1f}% {function}\n'
+        return text
+
+
+SAMPLING_PROFILER = SamplingProfiler()
+
+
+def _parse_cron_field(field: str, min_value: int, max_value: int) -> List[int]:
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_str = part.split('/')
+            step = int(step_str)
+
+        if part == '*':
+            start, end = min_value, max_value
+        elif '-' in part:
+            start, end = map(int, part.split('-'))
+        else:
+            start = int(part)
+            end = start if step == 1 else max_value
+
+        if step < 1 or start < min_value or end > max_value or start > end:
+            raise ValueError(f'Invalid cron field "{field}"')
+
+        values.update(range(start, end + 1, step))
+
+    return sorted(values)
+
+
+class CalendarSchedule:
+    """
+    Cron-style schedule "minute hour day month weekday" evaluated in the given timezone.
+    Weekdays are numbered as in cron: 0 or 7 is Sunday.
+    """
+
+    def __init__(self, expression: str, timezone: str = 'Europe/Moscow'):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Invalid cron expression "{expression}"')
+
+        self.expression = expression
+        self.timezone = pytz.timezone(timezone)
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = set(_parse_cron_field(fields[2], 1, 31))
+        self.months = set(_parse_cron_field(fields[3], 1, 12))
+        # cron sunday is 0 (or 7), python sunday is 6
+        self.weekdays = {(weekday + 6) % 7 for weekday in _parse_cron_field(fields[4], 0, 7)}
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+    def _is_day_matching(self, day: datetime.date) -> bool:
+        if day.month not in self.months:
+            return False
+
+        day_matching = day.day in self.days
+        weekday_matching = day.weekday() in self.weekdays
+
+        # same as cron: when both day and weekday are restricted, any of them is enough
+        if self.days_restricted and self.weekdays_restricted:
+            return day_matching or weekday_matching
+        return day_matching and weekday_matching
+
+    def _localize(self, day: datetime.date, hour: int, minute: int) -> datetime.datetime:
+        return self.timezone.localize(datetime.datetime(day.year, day.month, day.day, hour, minute))
+
+    def get_next_time(self, after: datetime.datetime) -> datetime.datetime:
+        day = after.astimezone(self.timezone).date()
+        for _ in range(366 * 5):
+            if self._is_day_matching(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = self._localize(day, hour, minute)
+                        if candidate > after:
+                            return candidate
+            day += datetime.timedelta(days=1)
+
+        raise ValueError(f'Cron expression "{self.expression}" never fires')
+
+    def get_previous_time(self, before: datetime.datetime) -> datetime.datetime or None:
+        day = before.astimezone(self.timezone).date()
+        for _ in range(366):
+            if self._is_day_matching(day):
+                for hour in reversed(self.hours):
+                    for minute in reversed(self.minutes):
+                        candidate = self._localize(day, hour, minute)
+                        if candidate <= before:
+                            return candidate
+            day -= datetime.timedelta(days=1)
+
+        return None
+
+
+def load_calendar_jobs_last_runs():
+    global CALENDAR_JOBS_LAST_RUNS, CALENDAR_JOBS_DELIVERIES
+
+    if os.path.isfile(CALENDAR_JOBS_FILEPATH):
+        try:
+            with open(CALENDAR_JOBS_FILEPATH, 'r', encoding='utf8') as stream:
+                CALENDAR_JOBS_LAST_RUNS = json.load(stream)
+        except Exception:
+            logging.error('!!! Failed to read calendar jobs last runs !!!')
+
+    if os.path.isfile(CALENDAR_JOBS_DELIVERIES_FILEPATH):
+        try:
+            with open(CALENDAR_JOBS_DELIVERIES_FILEPATH, 'r', encoding='utf8') as stream:
+                CALENDAR_JOBS_DELIVERIES = json.load(stream)
+        except Exception:
+            logging.error('!!! Failed to read calendar jobs deliveries !!!')
+
+
+def set_calendar_job_last_run(name: str, run_time: datetime.datetime):
+    CALENDAR_JOBS_LAST_RUNS[name] = run_time.isoformat()
+
+    os.makedirs(os.path.dirname(CALENDAR_JOBS_FILEPATH), exist_ok=True)
+    with open(CALENDAR_JOBS_FILEPATH, 'w', encoding='utf8') as stream:
+        json.dump(CALENDAR_JOBS_LAST_RUNS, stream, ensure_ascii=False)
+
+
+def is_calendar_job_delivered(name: str, run_time: datetime.datetime, chat_id: int) -> bool:
+    deliveries = CALENDAR_JOBS_DELIVERIES.get(name)
+    return deliveries is not None and deliveries['time'] == run_time.isoformat() and chat_id in deliveries['chats']
+
+
+def set_calendar_job_delivered(name: str, run_time: datetime.datetime, chat_id: int):
+    # only the latest occurrence is kept, retries of it skip chats which already got the message
+    deliveries = CALENDAR_JOBS_DELIVERIES.get(name)
+    if deliveries is None or deliveries['time'] != run_time.isoformat():
+        deliveries = {'time': run_time.isoformat(), 'chats': []}
+        CALENDAR_JOBS_DELIVERIES[name] = deliveries
+    deliveries['chats'].append(chat_id)
+
+    os.makedirs(os.path.dirname(CALENDAR_JOBS_DELIVERIES_FILEPATH), exist_ok=True)
+    with open(CALENDAR_JOBS_DELIVERIES_FILEPATH, 'w', encoding='utf8') as stream:
+        json.dump(CALENDAR_JOBS_DELIVERIES, stream, ensure_ascii=False)
+
+
+def get_calendar_job_last_run(name: str) -> datetime.datetime or None:
+    last_run = CALENDAR_JOBS_LAST_RUNS.get(name)
+    if last_run is None:
+        return None
+    return datetime.datetime.fromisoformat(last_run)
+
+
+class CalendarJob:
+    """
+    Scheduler job firing on a cron-style calendar schedule.
+
+    The last fired occurrence is persisted, so restarts do not duplicate runs. An occurrence missed while the bot
+    was down is fired on start if it is not older than catch_up seconds. Callback receives the occurrence time.
+    """
+
+    def __init__(self, name: str, expression: str, callback, timezone: str = 'Europe/Moscow', catch_up: int = 0):
+        self.name = name
+        self.schedule = CalendarSchedule(expression, timezone)
+        self.callback = callback
+        self.catch_up = catch_up
+        self.pending_time: datetime.datetime or None = None
+
+    def plan(self) -> float:
+        now = datetime.datetime.now(self.schedule.timezone)
+        last_run = get_calendar_job_last_run(self.name)
+
+        previous_time = self.schedule.get_previous_time(now)
+        if previous_time is not None and (last_run is None or last_run < previous_time) \
+                and (now - previous_time).total_seconds() <= self.catch_up:
+            self.pending_time = previous_time
+        else:
+            self.pending_time = self.schedule.get_next_time(now)
+
+        return max((self.pending_time - now).total_seconds(), 0)
+
+    async def run(self) -> float:
+        scheduled_time = self.pending_time
+        now = datetime.datetime.now(self.schedule.timezone)
+
+        # woken up too early (wall clock drift) or occurrence already fired
+        last_run = get_calendar_job_last_run(self.name)
+        if now < scheduled_time or (last_run is not None and last_run >= scheduled_time):
+            return self.plan()
+
+        try:
+            result = self.callback(scheduled_time)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            logging.error(f'Calendar job "{self.name}" failed:\n{traceback.format_exc()}')
+            next_delay = self.plan()
+            if self.pending_time == scheduled_time:
+                # retry the same occurrence while it is still in the catch up window
+                return 60
+            return next_delay
+
+        set_calendar_job_last_run(self.name, scheduled_time)
+        return self.plan()
+
+
+def get_calendar_jobs() -> List[CalendarJob]:
+    parking_config = CONFIGS['service']['scheduler'].get('parking_cleaning_notification', {})
+
+    return [
+        CalendarJob('parking_cleaning_notification',
+                    parking_config.get('cron', '30 20 * * *'),
+                    execute_parking_cleaning_notifications,
+                    timezone=parking_config.get('timezone', 'Europe/Moscow'),
+                    catch_up=parking_config.get('catch_up', 3 * 60 * 60)),
+    ]
+
+
+async def start_tables_synchronization():
+    SCHEDULER.add_job('tables_sync', reload_tables, interval=CONFIGS['service']['scheduler']['sync_interval'])
+
+
+def stop_tables_synchronization():
+    SCHEDULER.remove_job('tables_sync')
+
 
-                break
+async def start_caches_stale():
+    SCHEDULER.add_job('caches_stale', USERS_CACHE.stale)
 
-    return is_found, found_building_number, is_admin_chat, chat_name, chat_section, building_chats
 
+def stop_caches_stale():
+    SCHEDULER.remove_job('caches_stale')
 
-async def reload_tables_periodically():
-    while True:
-        reload_tables()
-        await asyncio.sleep(CONFIGS['service']['scheduler']['sync_interval'])
 
+async def start_tables_write_back():
+    SCHEDULER.add_job('tables_write_back', TABLES_WRITE_BACK.flush, delay=TABLES_WRITE_BACK.delay)
 
-async def start_tables_synchronization():
-    global TABLES_SYNC_TASK
-    if TABLES_SYNC_TASK is None:
-        TABLES_SYNC_TASK = asyncio.create_task(reload_tables_periodically())
 
+def stop_tables_write_back():
+    SCHEDULER.remove_job('tables_write_back')
 
-def stop_tables_synchronization():
-    global TABLES_SYNC_TASK
-    if TABLES_SYNC_TASK is not None:
-        TABLES_SYNC_TASK.cancel()
-        TABLES_SYNC_TASK = None
 
+async def start_invite_links_pool():
+    # first links are exported when the startup load is over
+    SCHEDULER.add_job('invite_links_pool', INVITE_LINKS_POOL.refill, delay=60)
 
-async def stale_caches_periodically():
-    while True:
-        USERS_CACHE.stale()
-        await asyncio.sleep(1)
 
+def stop_invite_links_pool():
+    SCHEDULER.remove_job('invite_links_pool')
 
-async def start_caches_stale():
-    global CACHES_STALE_TASK
-    if CACHES_STALE_TASK is None:
-        CACHES_STALE_TASK = asyncio.create_task(stale_caches_periodically())
 
+async def start_entities_cache_save():
+    SCHEDULER.add_job('entities_cache_save', ENTITIES_CACHE.save_if_changed,
+                      interval=CONFIGS['service']['scheduler']['context_save_interval'])
 
-def stop_caches_stale():
-    global CACHES_STALE_TASK
-    if CACHES_STALE_TASK is not None:
-        CACHES_STALE_TASK.cancel()
-        CACHES_STALE_TASK = None
+
+def stop_entities_cache_save():
+    SCHEDULER.remove_job('entities_cache_save')
 
 
 def reset_actions_queue():
@@ -1130,61 +3177,64 @@ def reset_actions_queue():
     QUEUED_ACTIONS = []
 
 
-async def proceed_actions_queue_periodically():
-    while True:
-        await proceed_actions_queue()
-        await asyncio.sleep(1)
+def save_actions_queue() -> int:
+    actions = [action for action in QUEUED_ACTIONS if not action.get('executed', False)]
 
+    os.makedirs(os.path.dirname(ACTIONS_QUEUE_FILEPATH), exist_ok=True)
+    with open(ACTIONS_QUEUE_FILEPATH, 'w', encoding='utf8') as stream:
+        json.dump(actions, stream, ensure_ascii=False)
 
-async def start_actions_queue():
-    global ACTIONS_QUEUE_TASK
-    if ACTIONS_QUEUE_TASK is None:
-        ACTIONS_QUEUE_TASK = asyncio.create_task(proceed_actions_queue_periodically())
+    return len(actions)
 
 
-def stop_actions_queue():
-    global ACTIONS_QUEUE_TASK
-    if ACTIONS_QUEUE_TASK is not None:
-        ACTIONS_QUEUE_TASK.cancel()
-        ACTIONS_QUEUE_TASK = None
+def load_actions_queue():
+    global QUEUED_ACTIONS
+
+    if not os.path.isfile(ACTIONS_QUEUE_FILEPATH):
+        return
+
+    try:
+        with open(ACTIONS_QUEUE_FILEPATH, 'r', encoding='utf8') as stream:
+            QUEUED_ACTIONS = json.load(stream) + QUEUED_ACTIONS
+    except Exception:
+        logging.error('!!! Failed to read actions queue !!!')
+        return
+
+    # the queue is stored again on the next shutdown, a crash should not repeat old actions
+    os.remove(ACTIONS_QUEUE_FILEPATH)
+    logging.info(f'Restored {len(QUEUED_ACTIONS)} queued actions')
+
+
+async def start_actions_queue():
+    SCHEDULER.add_job('actions_queue', proceed_actions_queue)
 
 
-async def proceed_scheduled_tasks_periodically():
-    while True:
-        await proceed_scheduled_tasks()
-        await asyncio.sleep(1)
+def stop_actions_queue():
+    SCHEDULER.remove_job('actions_queue')
 
 
 async def start_scheduled_tasks():
-    global SCHEDULED_TASKS_EXECUTION_TASK
-    if SCHEDULED_TASKS_EXECUTION_TASK is None:
-        SCHEDULED_TASKS_EXECUTION_TASK = asyncio.create_task(proceed_scheduled_tasks_periodically())
+    global CALENDAR_JOBS
 
+    stop_scheduled_tasks()
 
-def stop_scheduled_tasks():
-    global SCHEDULED_TASKS_EXECUTION_TASK
-    if SCHEDULED_TASKS_EXECUTION_TASK is not None:
-        SCHEDULED_TASKS_EXECUTION_TASK.cancel()
-        SCHEDULED_TASKS_EXECUTION_TASK = None
+    CALENDAR_JOBS = get_calendar_jobs()
+    for calendar_job in CALENDAR_JOBS:
+        SCHEDULER.add_job(calendar_job.name, calendar_job.run, delay=calendar_job.plan())
 
 
-async def proceed_users_context_save_periodically():
-    while True:
-        proceed_users_context_save()
-        await asyncio.sleep(1)
+def stop_scheduled_tasks():
+    for calendar_job in CALENDAR_JOBS:
+        SCHEDULER.remove_job(calendar_job.name)
 
 
 async def start_users_context_save():
-    global USERS_CONTEXT_SAVE_TASK
-    if USERS_CONTEXT_SAVE_TASK is None:
-        USERS_CONTEXT_SAVE_TASK = asyncio.create_task(proceed_users_context_save_periodically())
+    SCHEDULER.add_job('users_context_save', proceed_users_context_save,
+                      interval=CONFIGS['service']['scheduler']['context_save_interval'])
 
 
 def stop_users_context_save():
-    global USERS_CONTEXT_SAVE_TASK
-    if USERS_CONTEXT_SAVE_TASK is not None:
-        USERS_CONTEXT_SAVE_TASK.cancel()
-        USERS_CONTEXT_SAVE_TASK = None
+    SCHEDULER.remove_job('users_context_save')
 
 
 async def proceed_actions_queue():
@@ -1194,21 +3244,26 @@ async def proceed_actions_queue():
     # wait until telegram started
     if 'TG_BOT' not in globals():
         # logging.debug('TG bot is not ready yet')
-        return
+        return 1
     else:
+        messages_to_delete: Dict[int, List[int]] = {}
+
         for action in QUEUED_ACTIONS:
             if not action.get('executed', False):
                 if action['time'] < time.time():
 
                     # TODO: support more types
 
+                    METRICS.observe('actions_queue_lag_seconds', time.time() - action['time'])
+
                     if action['type'] == 'delete':
-                        logging.debug(f"Deleting message {action['message_id']} from {action['chat_id']}...")
-                        await TG_BOT.delete_message(chat_id=action['chat_id'],
-                                                    message_id=action['message_id'])
+                        messages_to_delete.setdefault(action['chat_id'], []).append(action['message_id'])
 
                     action['executed'] = True
 
+        for chat_id, messages_ids in messages_to_delete.items():
+            await tg_bot_delete_messages(chat_id, messages_ids)
+
         non_executed_actions = []
         for action in QUEUED_ACTIONS:
             if not action.get('executed', False):
@@ -1217,18 +3272,16 @@ async def proceed_actions_queue():
 
         QUEUED_ACTIONS_LAST_EXECUTED_TIME = time.time()
 
-
-async def proceed_scheduled_tasks():
-    await execute_parking_cleaning_notifications()
-    # TODO: run other time-specific stuff
+        # sleep until the nearest queued action, scheduler will be woken up by new actions
+        if QUEUED_ACTIONS:
+            return max(min(action['time'] for action in QUEUED_ACTIONS) - time.time(), 0)
+        return None
 
 
 def proceed_users_context_save():
-    interval = CONFIGS['service']['scheduler']['context_save_interval']
-    if time.time() - USERS_CACHE.last_save_time > interval:
-        logging.debug('Context save started...')
-        USERS_CACHE.save_users()
-        logging.debug('Context save finished...')
+    logging.debug('Context save started...')
+    USERS_CACHE.save_users()
+    logging.debug('Context save finished...')
 
 
 async def bot_send_message_user_not_authorized(update: Update, context: CallbackContext):
@@ -1392,13 +3445,10 @@ def get_short_object_type_str_by_id(object_type_id: str):
         return 'кв'
 
 
-def get_neighbours_list_str(neighbours: Dict[str, Dict[str, Dict[str, Any[str, List[Any[User, List[str]]]]]]],
-                            private: bool = False,
-                            show_objects: bool = False,
-                            split_floors: bool = False) -> str:
-    text = ''
-    lines = 0
-
+def iter_neighbours_list_lines(neighbours: Dict[str, Dict[str, Dict[str, Any[str, List[Any[ResidentView, List[str]]]]]]],
+                               private: bool = False,
+                               show_objects: bool = False,
+                               split_floors: bool = False) -> Iterator[str]:
     for floor_number, objects in neighbours.items():
 
         # TODO: remove this workaround for кл and мм
@@ -1407,12 +3457,13 @@ def get_neighbours_list_str(neighbours: Dict[str, Dict[str, Dict[str, Any[str, L
 
         if split_floors:
             if floor_number != '-1' or len(neighbours) != 1:
-                text += f'\n\n*{encode_markdown(str(floor_number))} этаж*'
+                yield ''
+                yield f'*{encode_markdown(str(floor_number))} этаж*'
 
         for object_number, object_description in objects.items():
             users_strs = []
             for user in object_description['users']:
-                if isinstance(user, User):
+                if isinstance(user, ResidentView):
                     if user.hidden:
                         user_str = '_скрыт_'
                     else:
@@ -1436,28 +3487,121 @@ def get_neighbours_list_str(neighbours: Dict[str, Dict[str, Dict[str, Any[str, L
 
                 users_strs.append(user_str)
 
-            text += '\n\\- '
+            line_parts = ['\\- ']
             if not split_floors:
                 if str(floor_number)[0] == '-':
-                    text += '\\'
-                text += f'{floor_number} этаж, '
+                    line_parts.append('\\')
+                line_parts.append(f'{floor_number} этаж, ')
 
             if show_objects:
-                text += f'{object_number} '
+                line_parts.append(f'{object_number} ')
 
                 if floor_number != '-1':
-                    text += f'\\({object_description["position"]}\\) '
+                    line_parts.append(f'\\({object_description["position"]}\\) ')
 
-                text += f'{object_description["type"]}: '
+                line_parts.append(f'{object_description["type"]}: ')
 
-            text += "; ".join(users_strs)
+            line_parts.append("; ".join(users_strs))
 
-            lines += 1
-            if lines > 50:
-                text += 'XXX_SPLITTER_XXX'
-                lines = 0
+            yield ''.join(line_parts)
 
-    return text.strip()
+
+def get_utf16_length(text: str) -> int:
+    # Telegram counts message length in UTF-16 code units
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_markdown_line(line: str, limit: int = TG_MESSAGE_MAX_LENGTH) -> List[str]:
+    """
+    Splits too long MarkdownV2 line by spaces outside of entities (links, code, bold and italic)
+    """
+    parts = []
+
+    while get_utf16_length(line) > limit:
+        split_position = None
+        hard_split_position = 0
+        length = 0
+        is_escaped = False
+        is_code = False
+        is_link_text = False
+        is_link_url = False
+        is_bold = False
+        is_italic = False
+
+        for i, symbol in enumerate(line):
+            symbol_length = 2 if ord(symbol) > 0xFFFF else 1
+            if length + symbol_length > limit:
+                break
+            length += symbol_length
+
+            if is_escaped:
+                is_escaped = False
+                hard_split_position = i + 1
+                continue
+
+            if symbol == '\\':
+                is_escaped = True
+                continue
+
+            hard_split_position = i + 1
+
+            if is_code:
+                is_code = symbol != '`'
+            elif is_link_url:
+                is_link_url = symbol != ')'
+            elif symbol == '`':
+                is_code = True
+            elif symbol == '[':
+                is_link_text = True
+            elif symbol == ']' and is_link_text:
+                is_link_text = False
+                is_link_url = i + 1 < len(line) and line[i + 1] == '('
+            elif symbol == '*':
+                is_bold = not is_bold
+            elif symbol == '_':
+                is_italic = not is_italic
+            elif symbol == ' ' and not (is_link_text or is_bold or is_italic):
+                split_position = i
+
+        if split_position:
+            parts.append(line[:split_position])
+            line = line[split_position + 1:]
+        else:
+            # no space outside of entities fits into the limit, nothing better than a hard split
+            parts.append(line[:hard_split_position])
+            line = line[hard_split_position:]
+
+    parts.append(line)
+    return parts
+
+
+def chunk_markdown_lines(lines: Iterable[str], limit: int = TG_MESSAGE_MAX_LENGTH) -> Iterator[str]:
+    """
+    Joins MarkdownV2 lines into messages as long as Telegram allows, lines are never split unless a single line
+    is longer than the limit. Chunks are yielded as soon as they are filled.
+    """
+    chunk_lines = []
+    chunk_length = 0
+
+    for line in lines:
+        for part in split_markdown_line(line, limit):
+            part_length = get_utf16_length(part)
+
+            if chunk_lines and chunk_length + 1 + part_length > limit:
+                chunk = '\n'.join(chunk_lines).strip('\n')
+                if chunk:
+                    yield chunk
+                chunk_lines = []
+                chunk_length = 0
+
+            if chunk_lines:
+                chunk_length += 1
+            chunk_lines.append(part)
+            chunk_length += part_length
+
+    chunk = '\n'.join(chunk_lines).strip('\n')
+    if chunk:
+        yield chunk
 
 
 @authorized_only
@@ -1467,56 +3611,69 @@ async def bot_command_neighbours(update: Update, context: CallbackContext):
         = identify_chat_by_tg_update(update)
     this_user = USERS_CACHE.get_user(update)
 
+    text_parts = None
+
     if is_admin_chat:
         if update.message.reply_to_message:
             requested_user = USERS_CACHE.get_user(update.message.reply_to_message.forward_origin.sender_user.id)
             neighbours = requested_user.get_neighbours()
+            lines = iter_neighbours_list_lines(neighbours,
+                                               private=True,
+                                               show_objects=True,
+                                               split_floors=True)
         else:
-            neighbours = USERS_CACHE.get_neighbours_from_section(chat_building)
-
-        text = get_neighbours_list_str(neighbours,
-                                       private=True,
-                                       show_objects=True,
-                                       split_floors=True)
+            text_parts = RENDER_CACHE.get_or_render(
+                ('neighbours', chat_building, None, 'private', 'show_objects', 'split_floors'),
+                lambda: list(chunk_markdown_lines(
+                    iter_neighbours_list_lines(USERS_CACHE.get_neighbours_from_section(chat_building),
+                                               private=True,
+                                               show_objects=True,
+                                               split_floors=True))))
     elif not chat_section:
         is_private = update.effective_chat.type == 'private'
         if update.message.reply_to_message:
             requested_user = USERS_CACHE.get_user(update.message.reply_to_message.forward_origin.sender_user.id)
             neighbours = requested_user.get_neighbours()
             if neighbours:
-                text = f'{requested_user.get_linked_shortname()} имеет ближайших соседей:\n' \
-                       + get_neighbours_list_str(neighbours, private=is_private)
+                lines = itertools.chain([f'{requested_user.get_linked_shortname()} имеет ближайших соседей:'],
+                                        iter_neighbours_list_lines(neighbours, private=is_private))
             else:
-                text = f'{requested_user.get_linked_shortname()} не имеет соседей рядом'
+                lines = [f'{requested_user.get_linked_shortname()} не имеет соседей рядом']
         else:
             if not is_private:
-                text = 'Используйте эту команду в чате секции или в приватной беседе, ' \
-                       'здесь её использовать нельзя'
+                lines = ['Используйте эту команду в чате секции или в приватной беседе, '
+                         'здесь её использовать нельзя']
             else:
                 neighbours = this_user.get_neighbours()
                 if neighbours:
-                    text = 'Ваши ближайшие соседи:\n\n' \
-                           + get_neighbours_list_str(neighbours, private=is_private,
-                                                     split_floors=True, show_objects=True)
+                    lines = itertools.chain(['Ваши ближайшие соседи:'],
+                                            iter_neighbours_list_lines(neighbours, private=is_private,
+                                                                       split_floors=True, show_objects=True))
                 else:
-                    text = 'К сожалению, у Вас еще нет соседей рядом'
+                    lines = ['К сожалению, у Вас еще нет соседей рядом']
     else:
         if update.message.reply_to_message:
             requested_user = USERS_CACHE.get_user(update.message.reply_to_message.forward_origin.sender_user.id)
             neighbours = requested_user.get_neighbours(section=chat_section)
             if neighbours:
-                text = f'{requested_user.get_linked_shortname()} имеет ближайших соседей:\n' \
-                       + get_neighbours_list_str(neighbours, private=False, show_objects=True)
+                lines = itertools.chain([f'{requested_user.get_linked_shortname()} имеет ближайших соседей:'],
+                                        iter_neighbours_list_lines(neighbours, private=False, show_objects=True))
             else:
-                text = f'{requested_user.get_linked_shortname()} не имеет соседей рядом'
+                lines = [f'{requested_user.get_linked_shortname()} не имеет соседей рядом']
         else:
-            neighbours = USERS_CACHE.get_neighbours_from_section(chat_building, chat_section)
-            text = get_neighbours_list_str(neighbours,
-                                           private=False,
-                                           show_objects=True,
-                                           split_floors=True)
-
-    for text_part in text.split('XXX_SPLITTER_XXX'):
+            text_parts = RENDER_CACHE.get_or_render(
+                ('neighbours', chat_building, chat_section, 'show_objects', 'split_floors'),
+                lambda: list(chunk_markdown_lines(
+                    iter_neighbours_list_lines(USERS_CACHE.get_neighbours_from_section(chat_building, chat_section),
+                                               private=False,
+                                               show_objects=True,
+                                               split_floors=True))))
+
+    if text_parts is None:
+        # chunks are sent as soon as they are rendered
+        text_parts = chunk_markdown_lines(lines)
+
+    for text_part in text_parts:
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text=text_part,
                                        reply_to_message_id=update.message.message_id,
@@ -1719,17 +3876,7 @@ async def bot_command_who_is_this(update: Update, context: CallbackContext):
                                    reply_markup=reply_markup)
 
 
-async def prepare_parking_cleaning_notification_text(building_number) -> str or None:
-    current_date = datetime.datetime.now()
-    next_day = current_date + datetime.timedelta(days=1)
-    formatted_date = next_day.strftime("%d.%m.%Y")
-
-    df = PARKING_CLEANING_DB[building_number]
-    search = df[df["date"] == formatted_date]
-    if search.empty:
-        return None
-
-    places_raw = search.iloc[0]["places"]
+def parse_parking_places(places_raw: str) -> List[int]:
     places = []
 
     for part in places_raw.split(";"):
@@ -1740,41 +3887,101 @@ async def prepare_parking_cleaning_notification_text(building_number) -> str or
         else:
             places.append(int(part))
 
-    text = f"Завтра {encode_markdown(formatted_date)} запланирована уборка следующих машиномест:"
-    for place in places:
-        text += f"\n\\- {place}"
-        place_data = get_object_persons(building_number, "мм", str(place))
+    return places
+
+
+def build_parking_cleaning_roster(building_number) -> Dict[str, Dict[int, List[str]]]:
+    residents_views = RESIDENTS_VIEWS[building_number]
+
+    # only the most related type of users is notified by default, others only if they explicitly agreed
+    places_recipients = {}
+    for (object_type, place_number), place in BUILDINGS_DIRECTORY[building_number].items():
+        if object_type != 'мм':
+            continue
+
+        recipients = []
         user_type_already_found = False
         for users_type in ['rents', 'residents', 'owners']:
-            if len(place_data[users_type]) > 0:
-                for user in place_data[users_type]:
-                    if (not user_type_already_found and user.parking_notifications is None) or user.parking_notifications is True:
-                        text += f" {user.get_linked_shortname()}"
+            place_users = [person['telegram'] for person in place['persons'][users_type] if person['telegram']]
+            if len(place_users) > 0:
+                for telegram_id in place_users:
+                    resident_view = residents_views.get(telegram_id)
+                    if resident_view is None:
+                        # telegram is not an id, skipped by build_residents_views()
+                        continue
+                    if (not user_type_already_found and resident_view.parking_notifications is None) \
+                            or resident_view.parking_notifications is True:
+                        recipients.append(resident_view.get_linked_shortname())
                 user_type_already_found = True
+        places_recipients[place_number] = recipients
 
-    return text
+    roster = {}
+    for date, places_raw in PARKING_CLEANING_DB[building_number][['date', 'places']].itertuples(index=False):
+        if date in roster:
+            continue
+        try:
+            places = parse_parking_places(places_raw)
+        except ValueError:
+            logging.error(f'Failed to parse parking cleaning places "{places_raw}" for {date}')
+            continue
+        roster[date] = {place: places_recipients.get(str(place), []) for place in places}
 
+    return roster
 
-async def execute_parking_cleaning_notifications():
-    global LAST_PARKING_CLEANING_NOTIFICATION_DATE
 
-    current_date = datetime.datetime.now(pytz.timezone('Europe/Moscow'))
-    formatted_current_date = current_date.strftime("%d.%m.%Y")
+async def prepare_parking_cleaning_notification_text(building_number,
+                                                      current_date: datetime.datetime = None) -> str or None:
+    if current_date is None:
+        current_date = datetime.datetime.now()
+    next_day = current_date + datetime.timedelta(days=1)
+    formatted_date = next_day.strftime("%d.%m.%Y")
 
-    if LAST_PARKING_CLEANING_NOTIFICATION_DATE == formatted_current_date:
-        return
+    places = PARKING_CLEANING_ROSTER.get(building_number, {}).get(formatted_date)
+    if places is None:
+        return None
 
-    if current_date.hour != 20 or current_date.minute != 30:
-        return
+    text = f"Завтра {encode_markdown(formatted_date)} запланирована уборка следующих машиномест:"
+    for place, recipients in places.items():
+        text += f"\n\\- {place}"
+        for recipient in recipients:
+            text += f" {recipient}"
+
+    return text
 
+
+async def execute_parking_cleaning_notifications(scheduled_time: datetime.datetime):
+    failed = []
     for building_number, _ in PARKING_CLEANING_DB.items():
-        text = await prepare_parking_cleaning_notification_text(building_number)
-        if text is not None:
-            for chat in CONFIGS['buildings'][str(building_number)]['groups']:
-                if chat['name'] == 'private_section_group' and chat['section'] == 'p':
-                    await TG_BOT.send_message(chat_id=chat['id'], text=text, parse_mode='MarkdownV2')
+        chats = [chat for chat in CONFIGS['buildings'][str(building_number)]['groups']
+                 if chat['name'] == 'private_section_group' and chat['section'] == 'p'
+                 and not is_calendar_job_delivered('parking_cleaning_notification', scheduled_time, chat['id'])]
+        if not chats:
+            continue
+
+        try:
+            text = await prepare_parking_cleaning_notification_text(building_number, scheduled_time)
+        except Exception:
+            logging.error(f'Failed to prepare parking cleaning notification for {building_number}:\n'
+                          f'{traceback.format_exc()}')
+            failed.append(building_number)
+            continue
+
+        if text is None:
+            continue
+
+        for chat in chats:
+            try:
+                await TG_BOT.send_message(chat_id=chat['id'], text=text, parse_mode='MarkdownV2')
+            except Exception:
+                logging.error(f'Failed to send parking cleaning notification to {chat["id"]}:\n'
+                              f'{traceback.format_exc()}')
+                failed.append(chat['id'])
+                continue
+            set_calendar_job_delivered('parking_cleaning_notification', scheduled_time, chat['id'])
 
-    LAST_PARKING_CLEANING_NOTIFICATION_DATE = formatted_current_date
+    if failed:
+        # the calendar job retries the occurrence, only these are tried again
+        raise RuntimeError(f'Parking cleaning notification is not delivered to {failed}')
 
 
 @authorized_only
@@ -1793,6 +4000,167 @@ async def bot_command_test_parking_cleaning_notification(update: Update, context
                                    parse_mode='MarkdownV2')
 
 
+@traced(category='pandas')
+def get_building_stats_str(chat_building) -> str:
+    text = ''
+    table = DB[chat_building]
+
+    objects = table[table['added_to_group'] == 'YES'][['object_type', 'number', 'entrance']].drop_duplicates()
+    text += 'Сейчас в чате дома представители:'
+
+    for object_type in ['кв', 'кл', 'мм', 'нж']:
+        amount = len(objects[objects['object_type'] == object_type].index)
+        object_type_max = CONFIGS['buildings'][chat_building]['objects_amount'][object_type]
+        percent = math.floor(amount / object_type_max * 100)
+        text += f'\n• {object_type}: {str(amount)} / {str(object_type_max)} ({str(percent)}%)'
+
+    text += '\n\nКоличество добавленных квартир по секциям:'
+    for number, value in objects[objects['object_type'] == 'кв'].groupby(by="entrance").size().items():
+        tb_flats = table[table['object_type'] == 'кв']
+        section_max = len(
+            tb_flats[tb_flats['entrance'] == number][['object_type', 'number', 'entrance']].drop_duplicates().index)
+        section_percent = math.floor(value / section_max * 100)
+        text += f'\n{number} секция: {value} / {str(section_max)} ({str(section_percent)}%)'
+
+    return text
+
+
+@traced(category='pandas')
+def get_section_stats_str(chat_building, chat_section) -> str:
+    text = ''
+    table = DB[chat_building]
+
+    neighbours_table = table[
+        (table['entrance'] == chat_section) & (table['added_to_group'] == 'YES') & (table['object_type'] == 'кв')][
+        ['number', 'floor']].drop_duplicates()
+    text += f'Всего квартир {chat_section}-й секции в этом чате: {len(neighbours_table.index)}'
+
+    text += f'\n\nКвартир в чате по каждому этажу:'
+    size_columns = neighbours_table.groupby(by="floor").size()
+    size_columns.index = size_columns.index.astype(int)
+    for floor_number, value in size_columns.sort_index().items():
+        if floor_number != -1:
+            text += f'\n{floor_number} этаж: {value}'
+
+    return text
+
+
+def get_metrics_summary_str() -> str:
+    def format_histogram(name: str, histogram: Dict) -> str:
+        return f'{histogram["count"]} раз, сред. {histogram["sum"] / histogram["count"] * 1000:.0f} мс, ' \
+               f'p95 до {METRICS.get_quantile(name, histogram, 0.95) * 1000:.0f} мс'
+
+    text = f'\n\nМетрики:'
+
+    handlers = sorted(METRICS.get_values('bot_handler_duration_seconds').items(),
+                      key=lambda item: item[1]['sum'], reverse=True)
+    errors = METRICS.get_values('bot_handler_errors_total')
+    text += f'\n- Обработчики (самые долгие):'
+    for labels, histogram in handlers[:5]:
+        text += f'\n  • {dict(labels)["handler"]}: {format_histogram("bot_handler_duration_seconds", histogram)}, ' \
+                f'ошибок {errors.get(labels, 0)}'
+
+    text += f'\n- Синхронизация таблиц:'
+    for labels, histogram in METRICS.get_values('tables_sync_duration_seconds').items():
+        labels = dict(labels)
+        text += f'\n  • {labels["building"]} {labels["sheet"]}: ' \
+                f'{format_histogram("tables_sync_duration_seconds", histogram)}'
+
+    api_methods = sorted(METRICS.get_values('telegram_api_request_duration_seconds').items(),
+                         key=lambda item: item[1]['count'], reverse=True)
+    text += f'\n- Запросы к Telegram:'
+    for labels, histogram in api_methods[:5]:
+        text += f'\n  • {dict(labels)["method"]}: ' \
+                f'{format_histogram("telegram_api_request_duration_seconds", histogram)}'
+
+    cache_requests = METRICS.get_values('users_cache_requests_total')
+    cache_evictions = METRICS.get_values('users_cache_evictions_total')
+    text += f'\n- Кэш пользователей: попаданий {cache_requests.get((("result", "hit"),), 0)}, ' \
+            f'промахов {cache_requests.get((("result", "miss"),), 0)}, ' \
+            f'вытеснено {sum(cache_evictions.values())}'
+
+    queue_lag = METRICS.get_values('actions_queue_lag_seconds').get(())
+    if queue_lag:
+        text += f'\n- Задержка очереди действий: {format_histogram("actions_queue_lag_seconds", queue_lag)}, ' \
+                f'макс. {queue_lag["max"] * 1000:.0f} мс'
+
+    return text
+
+
+def format_evictions(evictions: Dict[str, int]) -> str:
+    if not evictions:
+        return ''
+    return ' (' + ', '.join(f'{reason}: {amount}' for reason, amount in sorted(evictions.items())) + ')'
+
+
+def get_admin_stats_str() -> str:
+    text = f'\n\nАдминская статистика\n\n'
+
+    text += f'Таблицы:' \
+            f'\n- Таблиц в памяти: {len(DB)}' \
+            f'\n- Последняя синхронизация: {int(time.time() - TABLES_RELOADED_TIME)} сек. назад' \
+            f'\n- Ожидают записи в таблицы: {TABLES_WRITE_BACK.get_pending_count()}, ' \
+            f'записано ячеек: {TABLES_WRITE_BACK.written_cells}, ' \
+            f'конфликтов: {TABLES_WRITE_BACK.conflicts}, ошибок: {TABLES_WRITE_BACK.failures}'
+
+    cache_stats = USERS_CACHE.get_stats()
+    text += f'\n\nКэш:' \
+            f'\n- Пользователей в кэше: {cache_stats["cached_users"]} из {USERS_CACHE.max_size}, ' \
+            f'~{cache_stats["memory"] / 1024 / 1024:.1f} из {USERS_CACHE.max_memory / 1024 / 1024:.0f} МБ' \
+            f'\n- Попаданий: {cache_stats["hits"]}, промахов: {cache_stats["misses"]}, ' \
+            f'вытеснено: {sum(cache_stats["evictions"].values())}{format_evictions(cache_stats["evictions"])}' \
+            f'\n- Ожидающие сохранения: {cache_stats["users_save_queue"]}' \
+            f'\n- Последний флаш: {int(cache_stats["time_since_last_save"])} сек. назад' \
+            f'\n- Устаревание последнего закэшированного: {int(time.time() - LAST_STALED_USER_CACHE)} сек. назад' \
+            f'\n- Готовых ответов: {len(RENDER_CACHE.entries)}, попаданий: {RENDER_CACHE.hits}, ' \
+            f'промахов: {RENDER_CACHE.misses}'
+
+    invite_links_stats = INVITE_LINKS_POOL.get_stats()
+    text += f'\n\nСсылки-приглашения:' \
+            f'\n- Готовых ссылок: {invite_links_stats["links"]} для {invite_links_stats["chats"]} чатов, ' \
+            f'ожидают отзыва: {invite_links_stats["revoking"]}' \
+            f'\n- Выдано из запаса: {invite_links_stats["handed_out"]}, ' \
+            f'запрошено без запаса: {invite_links_stats["misses"]}'
+
+    text += f'\n\nОчередь действий:' \
+            f'\n- Запланировано в очереди: {len(QUEUED_ACTIONS)}' \
+            f'\n- Последнее исполнение очереди: {int(time.time() - QUEUED_ACTIONS_LAST_EXECUTED_TIME)} сек. назад'
+
+    rate_limiter_stats = TG_RATE_LIMITER.get_stats()
+    text += f'\n\nОтправка в Telegram:' \
+            f'\n- Запросов: {rate_limiter_stats["requests"]}, ожидают: {rate_limiter_stats["waiting"]}' \
+            f'\n- Повторов после лимита: {rate_limiter_stats["retries"]}, ' \
+            f'неудачных: {rate_limiter_stats["failed_requests"]}' \
+            f'\n- Ожидание: сред. {rate_limiter_stats["avg_wait_time"] * 1000:.0f} мс, ' \
+            f'макс. {rate_limiter_stats["max_wait_time"] * 1000:.0f} мс'
+
+    update_processor_stats = TG_UPDATE_PROCESSOR.get_stats()
+    text += f'\n\nОбработка обновлений:' \
+            f'\n- Обрабатывается: {update_processor_stats["processing"]} ' \
+            f'из {update_processor_stats["max_concurrent_updates"]}, ' \
+            f'обработано: {update_processor_stats["processed"]}, ' \
+            f'ждут очереди: {update_processor_stats["pending"] - update_processor_stats["processing"]}' \
+            f'\n- Ожидали очереди пользователя или чата: {update_processor_stats["contended"]}'
+
+    text += get_metrics_summary_str()
+
+    watchdog_stats = LOOP_WATCHDOG.get_stats()
+    text += f'\n\nБлокировки цикла событий:' \
+            f'\n- Всего: {watchdog_stats["stalls"]}, максимальная: {watchdog_stats["max_lag"] * 1000:.0f} мс'
+    for function, stalls in watchdog_stats['top_functions']:
+        text += f'\n  • {function}: {stalls}'
+
+    text += f'\n\nПланировщик:'
+    for job_name, job_stats in SCHEDULER.get_stats().items():
+        next_run_str = 'ожидает' if job_stats['next_run_in'] is None else f'{int(job_stats["next_run_in"])} сек.'
+        text += f'\n- {job_name}: запусков {job_stats["runs"]}, ошибок {job_stats["failures"]}, ' \
+                f'время {job_stats["last_duration"] * 1000:.0f} мс (сред. {job_stats["avg_duration"] * 1000:.0f} мс), ' \
+                f'задержка {job_stats["last_lag"] * 1000:.0f} мс (макс. {job_stats["max_lag"] * 1000:.0f} мс), ' \
+                f'следующий через {next_run_str}'
+
+    return text
+
+
 @authorized_only
 @known_chat_only
 # TODO: allow users for asking stats in private messages
@@ -1800,58 +4168,17 @@ async def bot_command_stats(update: Update, context: CallbackContext):
     is_found_chat, chat_building, is_admin_chat, chat_name, chat_section, building_chats \
         = identify_chat_by_tg_update(update)
 
-    text = ''
-    table = DB[chat_building]
-
     if is_found_chat and chat_section is None:
         # print stats for entire building or from user private chat
-        objects = table[table['added_to_group'] == 'YES'][['object_type', 'number', 'entrance']].drop_duplicates()
-        text += 'Сейчас в чате дома представители:'
-
-        for object_type in ['кв', 'кл', 'мм', 'нж']:
-            amount = len(objects[objects['object_type'] == object_type].index)
-            object_type_max = CONFIGS['buildings'][chat_building]['objects_amount'][object_type]
-            percent = math.floor(amount / object_type_max * 100)
-            text += f'\n• {object_type}: {str(amount)} / {str(object_type_max)} ({str(percent)}%)'
-
-        text += '\n\nКоличество добавленных квартир по секциям:'
-        for number, value in objects[objects['object_type'] == 'кв'].groupby(by="entrance").size().items():
-            tb_flats = table[table['object_type'] == 'кв']
-            section_max = len(
-                tb_flats[tb_flats['entrance'] == number][['object_type', 'number', 'entrance']].drop_duplicates().index)
-            section_percent = math.floor(value / section_max * 100)
-            text += f'\n{number} секция: {value} / {str(section_max)} ({str(section_percent)}%)'
+        text = RENDER_CACHE.get_or_render(('stats', chat_building, None),
+                                          lambda: get_building_stats_str(chat_building))
 
         if is_admin_chat:
-            text += f'\n\nАдминская статистика\n\n'
-
-            text += f'Таблицы:' \
-                    f'\n- Таблиц в памяти: {len(DB)}' \
-                    f'\n- Последняя синхронизация: {int(time.time() - TABLES_RELOADED_TIME)} сек. назад'
-
-            cache_stats = USERS_CACHE.get_stats()
-            text += f'\n\nКэш:' \
-                    f'\n- Пользователей в кэше: {cache_stats["cached_users"]}' \
-                    f'\n- Ожидающие сохранения: {cache_stats["users_save_queue"]}' \
-                    f'\n- Последний флаш: {int(cache_stats["time_since_last_save"])} сек. назад' \
-                    f'\n- Устаревание последнего закэшированного: {int(time.time() - LAST_STALED_USER_CACHE)} сек. назад'
-
-            text += f'\n\nОчередь действий:' \
-                    f'\n- Запланировано в очереди: {len(QUEUED_ACTIONS)}' \
-                    f'\n- Последнее исполнение очереди: {int(time.time() - QUEUED_ACTIONS_LAST_EXECUTED_TIME)} сек. назад'
+            text += get_admin_stats_str()
 
     else:
-        neighbours_table = table[
-            (table['entrance'] == chat_section) & (table['added_to_group'] == 'YES') & (table['object_type'] == 'кв')][
-            ['number', 'floor']].drop_duplicates()
-        text += f'Всего квартир {chat_section}-й секции в этом чате: {len(neighbours_table.index)}'
-
-        text += f'\n\nКвартир в чате по каждому этажу:'
-        size_columns = neighbours_table.groupby(by="floor").size()
-        size_columns.index = size_columns.index.astype(int)
-        for floor_number, value in size_columns.sort_index().items():
-            if floor_number != -1:
-                text += f'\n{floor_number} этаж: {value}'
+        text = RENDER_CACHE.get_or_render(('stats', chat_building, chat_section),
+                                          lambda: get_section_stats_str(chat_building, chat_section))
 
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text=text,
@@ -1868,6 +4195,10 @@ async def raw_try_send_user_link(update: Update, context: CallbackContext) -> Us
         return None
 
     if text[0] == '@':
+        telegram_id = RESIDENTS_INDEX.find_by_username(text)
+        if telegram_id:
+            return USERS_CACHE.get_user(telegram_id)
+
         user = await tg_client_get_user_by_username(text)
         if user:
             return user
@@ -1878,14 +4209,9 @@ async def raw_try_send_user_link(update: Update, context: CallbackContext) -> Us
     if not user_id.isdigit():
         return None
     else:
-        for number, building_table in DB.items():
-            user_rows = building_table[((building_table['telegram'] == user_id) | (building_table['phone'] == user_id))]
-            if not user_rows.empty:
-                user_row = user_rows.iloc[0]
-                telegram_id = user_row['telegram']
-                if telegram_id:
-                    user = USERS_CACHE.get_user(telegram_id)
-                    return user
+        telegram_id = RESIDENTS_INDEX.find_by_telegram(user_id) or RESIDENTS_INDEX.find_by_phone(user_id)
+        if telegram_id:
+            return USERS_CACHE.get_user(telegram_id)
 
         # if not detected
         user_id = await tg_client_get_user_id_by_phone(text)
@@ -1973,6 +4299,7 @@ async def bot_command_reload(update: Update, context: CallbackContext):
     logging.debug('Admin requested caches eviction!')
 
     USERS_CACHE.evict()
+    RENDER_CACHE.invalidate()
     reload_tables()
 
     await context.bot.send_message(chat_id=update.effective_chat.id,
@@ -2145,7 +4472,8 @@ async def bot_command_revalidate_users_groups(update: Update, context: CallbackC
         if not added_everywhere:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            parse_mode='MarkdownV2',
-                                           text=text)
+                                           text=text,
+                                           rate_limit_args={'priority': TG_PRIORITY_BULK})
             not_added_everywhere_counter += 1
         else:
             added_everywhere_counter += 1
@@ -2221,33 +4549,76 @@ async def cb_bulk_add_to_chats(update: Update, context: CallbackContext, *input_
         try:
             await user.add_to_chat(int(requested_chat_id))
             await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text=f'{i + 1}/{len(users)} добавлен "{user.get_fullname()}"')
+                                           text=f'{i + 1}/{len(users)} добавлен "{user.get_fullname()}"',
+                                           rate_limit_args={'priority': TG_PRIORITY_BULK})
             await asyncio.sleep(60)
         except Exception as e:
             print('An exception occurred')
             print(traceback.format_exc())
             await context.bot.send_message(chat_id=update.effective_chat.id,
-                                           text=f'{i + 1}/{len(users)} НЕ УДАЛОСЬ ДОБАВИТЬ "{user.get_fullname()}"\n\n{str(e)}')
+                                           text=f'{i + 1}/{len(users)} НЕ УДАЛОСЬ ДОБАВИТЬ "{user.get_fullname()}"\n\n{str(e)}',
+                                           rate_limit_args={'priority': TG_PRIORITY_BULK})
 
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text='Все пользователи добавлены!',
                                    reply_to_message_id=update.message.message_id)
 
 
+@authorized_only
+@admin_chat_only
+async def bot_command_start_profiler(update: Update, context: CallbackContext):
+    profiler_config = CONFIGS['service'].get('profiler', {})
+    duration = profiler_config.get('duration', 30)
+    if context.args:
+        try:
+            duration = float(context.args[0])
+        except ValueError:
+            pass
+    duration = min(max(duration, 1), profiler_config.get('max_duration', 600))
+
+    logging.debug(f'Admin requested profiling for {duration} sec.!')
+
+    if not SAMPLING_PROFILER.start(duration, update.effective_chat.id):
+        text = 'Профилирование уже запущено'
+    else:
+        text = f'Профилирование запущено на {duration:.0f} сек., результат будет отправлен в этот чат'
+
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text=text,
+                                   reply_to_message_id=update.message.message_id)
+
+
+@authorized_only
+@admin_chat_only
+async def bot_command_stop_profiler(update: Update, context: CallbackContext):
+    logging.debug('Admin requested stop profiling!')
+
+    if not await SAMPLING_PROFILER.stop():
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text='Профилирование не запущено',
+                                       reply_to_message_id=update.message.message_id)
+
+
 @authorized_only
 @admin_chat_only
 async def bot_command_current_time(update: Update, _):
     await TG_BOT.send_message(chat_id=update.effective_chat.id, text=str(datetime.datetime.now()))
 
 
-def schedule_garbage_message_deletion(update: Update, timeout: int):
-    logging.debug('Scheduled message deletion as a garbage')
+def schedule_message_deletion(chat_id: int, message_id: int, timeout: int):
+    action_time = round(time.time()) + timeout
     QUEUED_ACTIONS.append({
-        'time': round(time.time()) + timeout,
+        'time': action_time,
         'type': 'delete',
-        'chat_id': update.effective_chat.id,
-        'message_id': update.message.message_id
+        'chat_id': chat_id,
+        'message_id': message_id
     })
+    SCHEDULER.schedule_job('actions_queue', action_time - time.time(), only_earlier=True)
+
+
+def schedule_garbage_message_deletion(update: Update, timeout: int):
+    logging.debug('Scheduled message deletion as a garbage')
+    schedule_message_deletion(update.effective_chat.id, update.message.message_id, timeout)
 
     # set stats for user, who sended garbage
     user = USERS_CACHE.get_user(update)
@@ -2256,26 +4627,19 @@ def schedule_garbage_message_deletion(update: Update, timeout: int):
 
 
 def raw_try_setup_garbage_deletion(update: Update, context: CallbackContext) -> bool:
-    cleaner_timeouts = CONFIGS['service']['scheduler']['clean_garbage']
-
     if not update.message:
         return False
 
-    if update.message.sticker:
-        schedule_garbage_message_deletion(update, cleaner_timeouts['sticker'])
-        return True
-
-    if update.message.animation:
-        schedule_garbage_message_deletion(update, cleaner_timeouts['gif'])
-        return True
-
-    message_text = update.message.text
+    cleaner_config = GARBAGE_CLEANING_CONFIGS.get(update.effective_chat.id)
+    if cleaner_config is None:
+        return False
 
-    if is_repeated_symbol(message_text) or is_emoji(message_text):
-        schedule_garbage_message_deletion(update, cleaner_timeouts['emoji'])
-        return True
+    garbage_type = GARBAGE_CLASSIFIER.classify(update.message, cleaner_config)
+    if garbage_type is None:
+        return False
 
-    return False
+    schedule_garbage_message_deletion(update, cleaner_config[garbage_type])
+    return True
 
 
 async def stats_collector(update: Update, context: CallbackContext):
@@ -2329,16 +4693,10 @@ async def bot_assistant_call(update: Update, context: CallbackContext):
         await HELP_ASSISTANT.proceed_request(update, context, user, building_chats)
 
 
-async def remove_message_after_time(chat_id, message_id):
-    await asyncio.sleep(30)
-    logging.debug('Deleting message with added users list')
-    await TG_BOT.delete_message(chat_id=chat_id, message_id=message_id)
-
-
 async def bot_added_user_handler(update: Update, context: CallbackContext):
     if update.message and update.message.new_chat_members and len(update.message.new_chat_members) > 0:
-        logging.debug('Users added found')
-        await asyncio.create_task(remove_message_after_time(update.message.chat_id, update.message.message_id))
+        logging.debug('Users added found, scheduled deletion of message with added users list')
+        schedule_message_deletion(update.message.chat_id, update.message.message_id, 30)
 
 
 async def no_command_handler(update: Update, context: CallbackContext) -> None:
@@ -2539,6 +4897,8 @@ def get_chat_name_by_chat(chat) -> str:
 @authorized_only
 @admin_chat_only
 async def cb_add_to_chats(update: Update, context: CallbackContext, *input_args) -> None:
+    from telethon.errors import UserPrivacyRestrictedError
+
     try:
         user: User = USERS_CACHE.get_user(int(input_args[0]))
     except Exception:
@@ -2936,6 +5296,12 @@ def setup_command_handlers(application: Application):
     current_time_handler = CommandHandler('current_time', bot_command_current_time)
     application.add_handler(current_time_handler)
 
+    start_profiler_handler = CommandHandler('start_profiler', bot_command_start_profiler)
+    application.add_handler(start_profiler_handler)
+
+    stop_profiler_handler = CommandHandler('stop_profiler', bot_command_stop_profiler)
+    application.add_handler(stop_profiler_handler)
+
     test_parking_cleaning_notification_handler = CommandHandler('test_parking_cleaning', bot_command_test_parking_cleaning_notification)
     application.add_handler(test_parking_cleaning_notification_handler)
 
@@ -2947,27 +5313,383 @@ def setup_command_handlers(application: Application):
 
     application.add_handler(CallbackQueryHandler(handle_button_callback))
 
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = measure_handler(handler.callback)
+
+
+TG_PRIORITY_HIGH = 0
+TG_PRIORITY_NORMAL = 1
+TG_PRIORITY_BULK = 2
+
+TG_RATE_LIMITED_ENDPOINTS_PREFIXES = ('send', 'forward', 'copy', 'edit')
+
+
+class TokenBucket:
+    """
+    Token bucket, waiting requests are served by priority (lower is first) and then in arrival order
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters: List[tuple] = []
+        self.sequence = 0
+        self.drain_task: Task or None = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return not self.waiters and self.tokens >= self.capacity and self.blocked_until <= time.monotonic()
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, priority: int) -> None:
+        self._refill()
+        if not self.waiters and self.tokens >= 1 and self.blocked_until <= time.monotonic():
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.waiters, (priority, self.sequence, future))
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = asyncio.create_task(self._drain())
+        await future
+
+    async def _drain(self) -> None:
+        while self.waiters:
+            blocked_for = self.blocked_until - time.monotonic()
+            if blocked_for > 0:
+                await asyncio.sleep(blocked_for)
+                continue
+
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+
+            _, _, future = heapq.heappop(self.waiters)
+            if future.cancelled():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+
+class TelegramRateLimiter(BaseRateLimiter[Dict]):
+    """
+    Outbound bus for all Bot API requests made by the application bot.
+
+    Messages are limited per chat and globally with token buckets, requests with lower priority wait until more
+    important ones are sent. RetryAfter responses block the chat (or everything) for the requested time and the
+    request is retried. Priority can be passed with rate_limit_args={'priority': TG_PRIORITY_BULK}, by default
+    requests to admin chats are high priority and all other are normal.
+    """
+
+    def __init__(self, chat_rate: float = 1, global_rate: float = 30, max_retries: int = 3):
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats_buckets: Dict[int or str, TokenBucket] = {}
+        self.stats = {
+            'requests': 0,
+            'failed_requests': 0,
+            'retries': 0,
+            'waiting': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'requests_per_endpoint': {}
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for bucket in [self.global_bucket, *self.chats_buckets.values()]:
+            if bucket.drain_task is not None:
+                bucket.drain_task.cancel()
+
+    def _get_chat_bucket(self, chat_id: int or str) -> TokenBucket:
+        bucket = self.chats_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chats_buckets) > 1000:
+                for idle_chat_id in [key for key, value in self.chats_buckets.items() if value.is_idle()]:
+                    del self.chats_buckets[idle_chat_id]
+            bucket = TokenBucket(self.chat_rate, 1)
+            self.chats_buckets[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        chat_bucket = None
+        if chat_id is not None and endpoint.startswith(TG_RATE_LIMITED_ENDPOINTS_PREFIXES):
+            chat_bucket = self._get_chat_bucket(chat_id)
+
+        if rate_limit_args and 'priority' in rate_limit_args:
+            priority = rate_limit_args['priority']
+        elif chat_id is not None and chat_id in get_admin_chats_ids():
+            priority = TG_PRIORITY_HIGH
+        else:
+            priority = TG_PRIORITY_NORMAL
+
+        self.stats['requests'] += 1
+        self.stats['requests_per_endpoint'][endpoint] = self.stats['requests_per_endpoint'].get(endpoint, 0) + 1
+
+        retries = 0
+        while True:
+            started = time.monotonic()
+            self.stats['waiting'] += 1
+            try:
+                if chat_bucket is not None:
+                    await chat_bucket.acquire(priority)
+                await self.global_bucket.acquire(priority)
+            finally:
+                self.stats['waiting'] -= 1
+
+            wait_time = time.monotonic() - started
+            self.stats['total_wait_time'] += wait_time
+            self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+
+            request_started = time.perf_counter()
+            try:
+                with trace_span(endpoint, 'telegram', chat=chat_id, retry=retries):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                METRICS.inc('telegram_api_errors_total', method=endpoint)
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+
+                if retries >= self.max_retries:
+                    self.stats['failed_requests'] += 1
+                    raise
+
+                retries += 1
+                self.stats['retries'] += 1
+                logging.warning(f'Telegram flood limit on {endpoint} for chat {chat_id}, retry in {retry_after} sec.')
+                (chat_bucket or self.global_bucket).block(retry_after)
+            except Exception:
+                METRICS.inc('telegram_api_errors_total', method=endpoint)
+                raise
+            finally:
+                METRICS.observe('telegram_api_request_duration_seconds', time.perf_counter() - request_started,
+                                method=endpoint)
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            'chats_buckets': len(self.chats_buckets),
+            'avg_wait_time': self.stats['total_wait_time'] / self.stats['requests'] if self.stats['requests'] else 0.0
+        }
+
+
+def get_invite_chats_ids() -> List[int]:
+    chats_ids = []
+    for building_config in CONFIGS['buildings'].values():
+        for chat in building_config['groups']:
+            if chat['name'] != 'admin':
+                chats_ids.append(chat['id'])
+    return chats_ids
+
+
+def get_admin_chats_ids() -> List[int]:
+    chats_ids = []
+    for building_config in CONFIGS['buildings'].values():
+        for chat in building_config['groups']:
+            if chat['name'] == 'admin':
+                chats_ids.append(chat['id'])
+    return chats_ids
+
+
+class KeyedLocks:
+    """
+    Asyncio locks created on demand per key and dropped when nobody holds or waits for them.
+    Several keys are always taken in sorted order, so two holders can not wait for each other.
+    """
+
+    def __init__(self):
+        self.locks: Dict[Any, asyncio.Lock] = {}
+        self.holders: Dict[Any, int] = {}
+        self.contended = 0
+
+    async def acquire(self, keys: Iterable) -> List:
+        acquired = []
+        try:
+            for key in sorted(set(keys)):
+                lock = self.locks.get(key)
+                if lock is None:
+                    lock = asyncio.Lock()
+                    self.locks[key] = lock
+                self.holders[key] = self.holders.get(key, 0) + 1
+                if lock.locked():
+                    self.contended += 1
+
+                try:
+                    await lock.acquire()
+                except BaseException:
+                    self._forget(key)
+                    raise
+                acquired.append(key)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, keys: List) -> None:
+        for key in reversed(keys):
+            self.locks[key].release()
+            self._forget(key)
+
+    def _forget(self, key) -> None:
+        self.holders[key] -= 1
+        if self.holders[key] == 0:
+            del self.holders[key]
+            del self.locks[key]
+
+
+def get_update_lock_keys(update: object) -> List[tuple]:
+    keys = []
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            keys.append(('user', update.effective_user.id))
+        if update.effective_chat is not None:
+            keys.append(('chat', update.effective_chat.id))
+    return keys
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently, but updates of the same user or in the same chat are processed one by one
+    in the order they came, so users contexts and chats state are not changed by two handlers at once.
+
+    BaseUpdateProcessor takes its semaphore before do_process_update, so updates waiting for a busy user or chat
+    would hold its slots and one slow chat could stall all the others. Its semaphore is made unlimited and
+    the slots are taken only after the user and chat locks, by the head update of each of them.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(sys.maxsize)
+        self.slots_amount = max_concurrent_updates
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = KeyedLocks()
+        self.pending = 0
+        self.processing = 0
+        self.processed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        self.pending += 1
+        try:
+            with trace_span('update', 'update', **get_update_trace_args(update)):
+                with trace_span('update_lock', 'update'):
+                    keys = await self.locks.acquire(get_update_lock_keys(update))
+                try:
+                    with trace_span('update_slot', 'update'):
+                        await self.slots.acquire()
+                    self.processing += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.processing -= 1
+                        self.slots.release()
+                finally:
+                    self.locks.release(keys)
+        finally:
+            self.pending -= 1
+            self.processed += 1
+
+    async def drain(self, update_queue: asyncio.Queue, timeout: float) -> bool:
+        """
+        Waits for the updates already fetched from telegram: queued ones and the ones inside the processor
+        """
+        deadline = time.monotonic() + timeout
+        while (update_queue.qsize() or self.pending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not update_queue.qsize() and not self.pending
+
+    def get_stats(self) -> Dict:
+        return {
+            'max_concurrent_updates': self.slots_amount,
+            'pending': self.pending,
+            'processing': self.processing,
+            'processed': self.processed,
+            'locked_keys': len(self.locks.locks),
+            'contended': self.locks.contended
+        }
+
+
+def get_update_trace_args(update: object) -> Dict:
+    if not isinstance(update, Update):
+        return {}
+
+    args = {'update_id': update.update_id}
+    if update.effective_chat is not None:
+        args['chat'] = update.effective_chat.id
+    if update.effective_user is not None:
+        args['user'] = update.effective_user.id
+    if update.message is not None and update.message.text and update.message.text.startswith('/'):
+        args['command'] = update.message.text.split()[0]
+    elif update.callback_query is not None:
+        args['callback_data'] = update.callback_query.data
+    return args
+
 
 async def start_telegram_client():
     global TG_CLIENT
 
+    from telethon.sync import TelegramClient
+
     client_api_id = CONFIGS['service']['identity']['telegram']['client_api_id']
     client_api_hash = CONFIGS['service']['identity']['telegram']['client_api_hash']
 
-    TG_CLIENT = TelegramClient('configs/telegram_client',
-                               client_api_id,
-                               client_api_hash)
+    client = TelegramClient('configs/telegram_client',
+                            client_api_id,
+                            client_api_hash)
 
-    await TG_CLIENT.start()
+    started = time.perf_counter()
+    await client.start()
+    TG_CLIENT = client
 
-    logging.info('Telegram client started')
+    logging.info(f'Telegram client started in {time.perf_counter() - started:.2f} sec.')
 
 
-async def serve_telegram_requests():
-    global TG_BOT_APPLICATION, TG_BOT
+async def get_telegram_client() -> TelegramClient:
+    # the client is started by the first action which needs it, concurrent actions wait for the same start
+    async with TG_CLIENT_LOCK:
+        if TG_CLIENT is None:
+            await start_telegram_client()
+    return TG_CLIENT
+
+
+async def init_telegram_bot():
+    global TG_BOT_APPLICATION, TG_BOT, TG_RATE_LIMITER, TG_UPDATE_PROCESSOR
+
+    rate_limits_config = CONFIGS['service'].get('rate_limits', {})
+    TG_RATE_LIMITER = TelegramRateLimiter(chat_rate=rate_limits_config.get('chat_rate', 1),
+                                          global_rate=rate_limits_config.get('global_rate', 30),
+                                          max_retries=rate_limits_config.get('max_retries', 3))
 
     builder = ApplicationBuilder()
     builder.token(token=CONFIGS['service']['identity']['telegram']['bot_token'])
+    builder.rate_limiter(TG_RATE_LIMITER)
+
+    # slow handlers of one chat do not stall the others, updates of one user or chat stay ordered
+    TG_UPDATE_PROCESSOR = OrderedUpdateProcessor(CONFIGS['service'].get('concurrent_updates', 64))
+    builder.concurrent_updates(TG_UPDATE_PROCESSOR)
 
     application: Application = builder.build()
 
@@ -2977,55 +5699,192 @@ async def serve_telegram_requests():
     setup_command_handlers(application)
 
     await application.initialize()
+
+
+async def serve_telegram_requests():
+    application = TG_BOT_APPLICATION
     await application.start()
 
-    await application.updater.start_polling()
+    allowed_updates = CONFIGS['service'].get('allowed_updates', TG_ALLOWED_UPDATES)
+    webhook_config = CONFIGS['service'].get('webhook')
+    if webhook_config:
+        # Telegram pushes updates to the embedded HTTP server, requests without the secret token are rejected
+        await application.updater.start_webhook(listen=webhook_config.get('listen', '0.0.0.0'),
+                                                port=webhook_config.get('port', 8443),
+                                                url_path=webhook_config.get('path', ''),
+                                                webhook_url=webhook_config.get('url'),
+                                                secret_token=webhook_config.get('secret_token'),
+                                                allowed_updates=allowed_updates)
+        logging.info(f'Receiving updates by webhook on port {webhook_config.get("port", 8443)}')
+    else:
+        await application.updater.start_polling(allowed_updates=allowed_updates)
+        logging.info('Receiving updates by polling')
+
 
+async def stop_receiving_updates():
+    if TG_BOT_APPLICATION.updater.running:
+        await TG_BOT_APPLICATION.updater.stop()
 
-async def on_exit():
 
-    logging.info('Stopping telegram bot...')
-    await TG_BOT_APPLICATION.updater.stop()
-    await TG_BOT_APPLICATION.stop()
+async def drain_telegram_bot(timeout: float):
+    deadline = time.monotonic() + timeout
+    update_queue = TG_BOT_APPLICATION.update_queue
+    if not await TG_UPDATE_PROCESSOR.drain(update_queue, timeout):
+        # Application.stop() would wait for them without a deadline
+        logging.warning(f'{update_queue.qsize() + TG_UPDATE_PROCESSOR.pending} updates were not finished '
+                        f'in {timeout} sec., they are dropped')
+        return
+
+    try:
+        # the rest of the deadline bounds the application tasks and persistence updates
+        await asyncio.wait_for(stop_telegram_bot_application(), max(deadline - time.monotonic(), 1))
+    except asyncio.TimeoutError:
+        logging.warning(f'Telegram bot was not stopped in {timeout} sec.')
+
+
+async def stop_telegram_bot_application():
+    if TG_BOT_APPLICATION.running:
+        await TG_BOT_APPLICATION.stop()
     await TG_BOT_APPLICATION.shutdown()
 
-    logging.info('Stopping tables sync...')
-    stop_tables_synchronization()
 
-    logging.info('Stopping actions queue...')
-    stop_actions_queue()
+async def run_shutdown_step(timeline: 'Timeline', name: str, awaitable: Awaitable[Any]) -> Any:
+    """
+    A failed step is logged and does not prevent the next ones, each of them saves its own state
+    """
+    try:
+        return await timeline.step(name, awaitable)
+    except Exception:
+        logging.error(f'Shutdown step "{name}" failed: {traceback.format_exc()}')
+        return None
 
-    logging.info('Stopping users context save...')
-    stop_users_context_save()
 
-    logging.info('Stopping telegram client...')
-    TG_CLIENT.disconnect()
+async def call_shutdown_step(timeline: 'Timeline', name: str, func: Callable, *args) -> Any:
+    async def call():
+        return func(*args)
 
-    logging.info('Please wait until caches evicted...')
-    USERS_CACHE.evict()
+    return await run_shutdown_step(timeline, name, call())
 
-    # TODO: store actions queue
 
+async def on_exit():
+    """
+    Stops receiving updates first, then waits for in-flight updates until the deadline. Local state is written
+    before the tables write back, which is the slowest and may fail.
+    """
+    timeline = Timeline('Shutdown')
+    shutdown_config = CONFIGS['service'].get('shutdown', {})
+
+    if 'TG_BOT_APPLICATION' in globals():
+        logging.info('Stopping telegram bot...')
+        await run_shutdown_step(timeline, 'receiving updates', stop_receiving_updates())
+        await run_shutdown_step(timeline, 'in-flight updates',
+                                drain_telegram_bot(shutdown_config.get('drain_timeout', 5)))
+
+    logging.info('Stopping scheduler...')
+    await call_shutdown_step(timeline, 'scheduler', SCHEDULER.stop)
+    # a running write back job would overlap the final flush below
+    await run_shutdown_step(timeline, 'running jobs',
+                            SCHEDULER.wait_running_jobs(shutdown_config.get('jobs_timeout', 5)))
+    await call_shutdown_step(timeline, 'loop watchdog', LOOP_WATCHDOG.stop)
+    await call_shutdown_step(timeline, 'metrics server', stop_metrics_server)
+
+    # contexts are written in the loop thread: handlers which outlived the drain deadline may still change them
+    logging.info('Please wait until users contexts saved...')
+    await call_shutdown_step(timeline, f'users contexts ({len(USERS_CACHE.scheduled_saves)})',
+                             USERS_CACHE.save_users)
+
+    await call_shutdown_step(timeline, 'entities cache', ENTITIES_CACHE.save_if_changed)
+
+    actions_amount = await call_shutdown_step(timeline, 'actions queue', save_actions_queue)
+    if actions_amount is not None:
+        logging.info(f'Stored {actions_amount} queued actions')
+
+    logging.info('Please wait until tables updates written...')
+    await run_shutdown_step(timeline, f'tables write back ({TABLES_WRITE_BACK.get_pending_count()})',
+                            TABLES_WRITE_BACK.flush())
+
+    if TG_CLIENT is not None:
+        logging.info('Stopping telegram client...')
+        await run_shutdown_step(timeline, 'telegram client', TG_CLIENT.disconnect())
+
+    logging.info(timeline.get_timeline_str())
     logging.info('Good bye!')
-    os.kill(os.getpid(), 9)
+
+
+class Timeline:
+    """
+    Steps durations relative to the timeline beginning, steps running concurrently overlap
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+        self.started = time.perf_counter()
+        self.steps: List[tuple] = []
+
+    async def step(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.steps.append((name, started - self.started, time.perf_counter() - started))
+
+    def get_timeline_str(self) -> str:
+        text = f'{self.title} took {time.perf_counter() - self.started:.2f} sec.:'
+        for name, offset, duration in sorted(self.steps, key=lambda step: step[1]):
+            text += f'\n  {offset:6.2f} +{duration:.2f} sec. {name}'
+        return text
+
+
+async def prepare_tables():
+    await connect_google_service()
+    # the first synchronization is blocking, it runs in a thread while the bot is initialized
+    await asyncio.to_thread(reload_tables)
+
+
+def install_shutdown_signals_handlers(shutdown_requested: asyncio.Event):
+    # docker stops containers by SIGTERM, the default handler would exit without saving anything
+    loop = asyncio.get_running_loop()
+    for shutdown_signal in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(shutdown_signal, shutdown_requested.set)
+        except NotImplementedError:
+            pass
 
 
 async def main():
+    timeline = Timeline('Startup')
+    shutdown_requested = asyncio.Event()
+    install_shutdown_signals_handlers(shutdown_requested)
     try:
-        await reload_configs()
-        await start_telegram_client()
+        await timeline.step('configs', reload_configs())
+        load_actions_queue()
+
+        # updates are received only when tables are loaded, otherwise residents would not be recognized
+        init_steps = [timeline.step('google service and tables', prepare_tables()),
+                      timeline.step('telegram bot', init_telegram_bot())]
+        if not CONFIGS['service'].get('lazy_telegram_client', True):
+            init_steps.append(timeline.step('telegram client', start_telegram_client()))
+        await asyncio.gather(*init_steps)
+
+        SCHEDULER.start()
+        LOOP_WATCHDOG.start()
         await start_actions_queue()
         await start_users_context_save()
-        await connect_google_service()
         await start_tables_synchronization()
+        await start_tables_write_back()
         await start_caches_stale()
         await start_scheduled_tasks()
-        await serve_telegram_requests()
+        await start_invite_links_pool()
+        await start_entities_cache_save()
+        await timeline.step('metrics server', start_metrics_server())
+        await timeline.step('receiving updates', serve_telegram_requests())
 
         logging.info('Bot started')
+        logging.info(timeline.get_timeline_str())
 
-        while True:
-            await asyncio.sleep(0.1)
+        # everything else runs in scheduler and telegram tasks
+        await shutdown_requested.wait()
+        logging.info('Shutdown requested')
 
     except Exception as e:
         traceback.print_exc()
@@ -3034,4 +5893,7 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
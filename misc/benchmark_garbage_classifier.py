@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+import time
+
+import emoji
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import GarbageClassifier  # noqa: E402
+
+# Telegram Desktop chat export (result.json) or a plain text file with one message per line
+CORPUS_PATH = '../data/messages.json'
+ROUNDS = 10
+
+
+def load_corpus(path):
+    if not path.endswith('.json'):
+        with open(path, 'r', encoding='utf8') as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+
+    with open(path, 'r', encoding='utf8') as f:
+        export = json.load(f)
+
+    messages = []
+    for message in export.get('messages', []):
+        text = message.get('text')
+        if isinstance(text, list):
+            text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+        if text:
+            messages.append(text)
+    return messages
+
+
+def legacy_classify(s):
+    # per-codepoint checks used before GarbageClassifier
+    if len(set(s.lower())) == 1:
+        return 'repeated'
+    for symbol in set(s.lower()):
+        if symbol not in emoji.EMOJI_DATA:
+            return None
+    return 'emoji'
+
+
+def measure(name, classify, messages):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for message in messages:
+            classify(message)
+    elapsed = time.perf_counter() - started
+    per_message = elapsed / (ROUNDS * len(messages)) * 1000000
+    print('%s: %.3f sec total, %.2f us per message' % (name, elapsed, per_message))
+
+
+def main():
+    corpus_path = sys.argv[1] if len(sys.argv) > 1 else CORPUS_PATH
+    messages = load_corpus(corpus_path)
+    if not messages:
+        print('Corpus is empty')
+        return
+
+    print('Messages in corpus: %s' % len(messages))
+
+    started = time.perf_counter()
+    classifier = GarbageClassifier()
+    print('Classifier compiled in %.3f sec' % (time.perf_counter() - started))
+
+    measure('legacy', legacy_classify, messages)
+    measure('classifier', classifier.classify_text, messages)
+
+    stats = {}
+    disagreements = []
+    for message in messages:
+        new_result = classifier.classify_text(message)
+        old_result = legacy_classify(message)
+        stats[new_result] = stats.get(new_result, 0) + 1
+        if (new_result is None) != (old_result is None):
+            disagreements.append((message, old_result, new_result))
+
+    print('Classified: %s' % stats)
+    print('Disagreements with legacy: %s' % len(disagreements))
+    for message, old_result, new_result in disagreements[:20]:
+        print('  %r: %s -> %s' % (message, old_result, new_result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import fake_sheets  # noqa: E402
+
+# Usage:
+#     python3 benchmark_tables_sync.py --objects 1000 10000 100000 --save baseline.json
+#     python3 benchmark_tables_sync.py --objects 1000 10000 100000 --compare baseline.json
+#
+# Every timing is a median of several rounds in milliseconds, memory is in megabytes.
+
+ROUNDS = 5
+USERS_SAMPLE = 200
+REGRESSION_TOLERANCE = 1.5
+
+
+def measure(func, rounds=ROUNDS):
+    durations = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations)
+
+
+def force_full_sync():
+    main.TABLES_RELOADED_TIME = 0
+    main.TABLES_SOURCES.clear()
+    main.reload_tables()
+
+
+def force_unchanged_sync():
+    main.TABLES_RELOADED_TIME = 0
+    main.reload_tables()
+
+
+def construct_users(telegram_ids):
+    for telegram_id in telegram_ids:
+        main.User(telegram_id, main.USERS_CACHE).is_identified()
+
+
+def load_users(telegram_ids):
+    for telegram_id in telegram_ids:
+        user = main.User(telegram_id, main.USERS_CACHE)
+        user.get_linked_fullname()
+        user.get_related_chats()
+        user.get_related_users()
+
+
+def render_neighbours(building, sections):
+    for section in sections:
+        list(main.chunk_markdown_lines(
+            main.iter_neighbours_list_lines(main.USERS_CACHE.get_neighbours_from_section(building, section),
+                                            private=False,
+                                            show_objects=True,
+                                            split_floors=True)))
+
+
+def render_stats(building, sections):
+    main.get_building_stats_str(building)
+    for section in sections:
+        main.get_section_stats_str(building, section)
+
+
+def benchmark(buildings_amount, objects_amount):
+    backend = fake_sheets.install(main, fake_sheets.generate_buildings(main, buildings_amount, objects_amount))
+    main.TABLES_SOURCES.clear()
+    main.RESIDENTS_INDEX.buildings.clear()
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    force_full_sync()
+    first_sync = (time.perf_counter() - started) * 1000
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    building = next(iter(main.CONFIGS['buildings']))
+    sections = [str(s) for s in range(1, fake_sheets.SECTIONS + 1)]
+
+    table = main.DB[building]
+    telegram_ids = [int(t) for t in table['telegram'].unique() if t]
+    telegram_ids = random.Random(34).sample(telegram_ids, min(USERS_SAMPLE, len(telegram_ids)))
+
+    results = {
+        'rows': len(table.index),
+        'first_sync_ms': first_sync,
+        'full_sync_ms': measure(force_full_sync),
+        'unchanged_sync_ms': measure(force_unchanged_sync),
+        'memory_per_building_mb': (memory_after - memory_before) / buildings_amount / 1024 / 1024,
+        'memory_peak_mb': (memory_peak - memory_before) / 1024 / 1024,
+        'dataframe_per_building_mb': table.memory_usage(deep=True).sum() / 1024 / 1024,
+        'user_construct_ms': measure(lambda: construct_users(telegram_ids)) / max(len(telegram_ids), 1),
+        'user_load_ms': measure(lambda: load_users(telegram_ids)) / max(len(telegram_ids), 1),
+        'neighbours_ms': measure(lambda: render_neighbours(building, sections)) / len(sections),
+        'neighbours_building_ms': measure(lambda: render_neighbours(building, [None])),
+        'stats_ms': measure(lambda: render_stats(building, sections)),
+        'sheets_reads': backend.reads,
+    }
+    return results
+
+
+def print_results(objects_amount, results):
+    print(f'\n{objects_amount} objects per building ({results["rows"]} rows):')
+    for name, value in results.items():
+        if name == 'rows':
+            continue
+        print(f'  {name}: {value:.3f}' if isinstance(value, float) else f'  {name}: {value}')
+
+
+def compare(baseline, all_results):
+    regressions = []
+    for objects_amount, results in all_results.items():
+        baseline_results = baseline.get(objects_amount)
+        if not baseline_results:
+            continue
+        for name, value in results.items():
+            if not name.endswith('_ms') and not name.endswith('_mb'):
+                continue
+            baseline_value = baseline_results.get(name)
+            if baseline_value and value > baseline_value * REGRESSION_TOLERANCE:
+                regressions.append(f'{objects_amount} objects, {name}: {baseline_value:.3f} -> {value:.3f}')
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Tables synchronization benchmark on a local fake Sheets backend')
+    parser.add_argument('--objects', type=int, nargs='+', default=[1000, 10000],
+                        help='objects per building, one benchmark per value')
+    parser.add_argument('--buildings', type=int, default=1)
+    parser.add_argument('--save', help='save results to JSON file')
+    parser.add_argument('--compare', help='compare with results saved before, fails on regressions')
+    args = parser.parse_args()
+
+    all_results = {}
+    for objects_amount in args.objects:
+        results = benchmark(args.buildings, objects_amount)
+        all_results[str(objects_amount)] = results
+        print_results(objects_amount, results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf8') as f:
+            json.dump(all_results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            regressions = compare(json.load(f), all_results)
+        if regressions:
+            print(f'\nRegressions (more than x{REGRESSION_TOLERANCE}):')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('\nNo regressions')
+
+
+if __name__ == '__main__':
+    main_benchmark()
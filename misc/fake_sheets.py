@@ -0,0 +1,248 @@
+import datetime
+import random
+
+# Local stand-in for Google Sheets API, injected into main instead of googleapiclient.discovery.build:
+#
+#     import main
+#     import fake_sheets
+#     fake_sheets.install(main, fake_sheets.generate_buildings(main, 2, 10000))
+#
+# Spreadsheets are kept in memory as lists of rows, values().get() and values().batchUpdate() are supported.
+
+SECTIONS = 6
+FLOOR_POSITIONS = 10
+SECTIONS_CHATS_ID_BASE = -1001000000000
+
+NAMES = ['Иван', 'Пётр', 'Сергей', 'Анна', 'Мария', 'Ольга', 'Дмитрий', 'Елена', 'Алексей', 'Наталья']
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов',
+            'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов']
+PATRONYMICS = ['Иванович', 'Петрович', 'Сергеевич', 'Андреевна', 'Олеговна', '']
+
+ASSISTANT_ROWS = [
+    ['Интернет', 'Готов', 'интернет|провайдер', '', 'Подключить интернет можно у провайдеров дома', 'интернет'],
+    ['Ключи', 'Готов', 'ключ|брелок', '', 'Ключи выдаёт управляющая компания', 'ключи'],
+    ['Соседи', 'Готов', 'соседи', 'command neighbours', '', 'соседи'],
+]
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeValues:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, spreadsheetId, range):
+        self.backend.reads += 1
+        return FakeRequest({'values': [list(row) for row in self.backend.tables[spreadsheetId]]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.backend.writes += 1
+        rows = self.backend.tables[spreadsheetId]
+        first_column, first_row = self.backend.origins[spreadsheetId]
+        for data in body['data']:
+            cell = data['range'].rsplit('!', 1)[-1]
+            column_letters = ''.join(c for c in cell if c.isalpha())
+            column_index = 0
+            for letter in column_letters:
+                column_index = column_index * 26 + ord(letter) - ord('A') + 1
+            column = column_index - 1 - first_column
+            row = rows[int(''.join(c for c in cell if c.isdigit())) - first_row]
+            row.extend([''] * (column + 1 - len(row)))
+            row[column] = data['values'][0][0]
+        return FakeRequest({'totalUpdatedCells': len(body['data'])})
+
+
+class FakeSpreadsheets:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def values(self):
+        return FakeValues(self.backend)
+
+
+class FakeSheetsBackend:
+    def __init__(self):
+        self.tables = {}
+        self.origins = {}
+        self.reads = 0
+        self.writes = 0
+
+    def add_spreadsheet(self, spreadsheet_id, rows, first_column=0, first_row=2):
+        self.tables[spreadsheet_id] = rows
+        self.origins[spreadsheet_id] = (first_column, first_row)
+
+    def build(self, service_name, version, credentials=None, cache_discovery=False):
+        return self
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+
+def get_objects_amounts(objects_amount):
+    amounts = {
+        'кв': int(objects_amount * 0.75),
+        'кл': int(objects_amount * 0.15),
+        'мм': int(objects_amount * 0.08),
+    }
+    amounts['нж'] = objects_amount - sum(amounts.values())
+    return amounts
+
+
+def generate_people_rows(columns, objects_amount, seed=34, telegram_id_base=100000000):
+    """
+    Rows of the people table: 75% flats, 15% storerooms, 8% parking places and 2% commercial premises,
+    most of the objects have one or two persons, a part of the owners also have parking places or storerooms
+    """
+    rnd = random.Random(seed)
+    amounts = get_objects_amounts(objects_amount)
+
+    flats_per_section = max(amounts['кв'] // SECTIONS, 1)
+    floors = max(flats_per_section // FLOOR_POSITIONS, 1) + 1
+
+    persons = []
+    rows = []
+    property_id = 0
+
+    def make_row(**values):
+        row = {column: '' for column in columns}
+        row.update(values)
+        return [row[column] for column in columns]
+
+    def make_person():
+        telegram_id = str(telegram_id_base + len(persons)) if rnd.random() < 0.7 else ''
+        person = {
+            'surname': rnd.choice(SURNAMES),
+            'name': rnd.choice(NAMES),
+            'patronymic': rnd.choice(PATRONYMICS),
+            'telegram': telegram_id,
+            'phone': '7999%07d' % len(persons) if rnd.random() < 0.8 else '',
+            'username': 'user%s' % len(persons) if telegram_id and rnd.random() < 0.5 else '',
+            'added_to_group': 'YES' if telegram_id and rnd.random() < 0.8 else 'NO',
+            'show_phone': rnd.choice(['YES', 'NO', '']),
+            'parking_notifications': rnd.choice(['YES', 'NO', '', '', '']),
+            'hidden': 'YES' if rnd.random() < 0.05 else '',
+        }
+        persons.append(person)
+        return person
+
+    for object_type, amount in amounts.items():
+        for number in range(1, amount + 1):
+            property_id += 1
+            if object_type == 'кв':
+                entrance = str((number - 1) // flats_per_section % SECTIONS + 1)
+                index_in_section = (number - 1) % flats_per_section
+                floor = str(index_in_section // FLOOR_POSITIONS % floors + 2)
+                floor_position = str(index_in_section % FLOOR_POSITIONS + 1)
+            elif object_type == 'мм':
+                entrance, floor, floor_position = '0', '-1', '0'
+            elif object_type == 'кл':
+                entrance, floor, floor_position = '0', '1', '0'
+            else:
+                # commercial premises are on the first floors of sections
+                entrance, floor, floor_position = str((number - 1) % SECTIONS + 1), '1', '0'
+
+            object_values = {
+                'property_id': str(property_id),
+                'entrance': entrance,
+                'floor': floor,
+                'floor_position': floor_position,
+                'object_type': object_type,
+                'number': str(number),
+                'area': str(rnd.randint(3, 120)),
+                'rooms': str(rnd.randint(1, 4)) if object_type == 'кв' else '',
+            }
+
+            roll = rnd.random()
+            if roll < 0.15:
+                object_persons = []
+            elif object_type != 'кв' and persons and roll < 0.45:
+                object_persons = [(rnd.choice(persons), 'собственник')]
+            elif roll < 0.8:
+                object_persons = [(make_person(), 'собственник')]
+            else:
+                object_persons = [(make_person(), 'собственник'),
+                                  (make_person(), rnd.choice(['арендатор', 'пользователь']))]
+
+            if not object_persons:
+                rows.append(make_row(**object_values))
+            for person, user_type in object_persons:
+                rows.append(make_row(user_type=user_type, **object_values, **person))
+
+    return rows
+
+
+def generate_parking_cleaning_rows(parking_places, days=60):
+    rows = []
+    date = datetime.date.today()
+    places_per_day = max(parking_places // 10, 1)
+    for day in range(days):
+        start = day * places_per_day % max(parking_places, 1) + 1
+        end = min(start + places_per_day - 1, parking_places)
+        rows.append([(date + datetime.timedelta(days=day)).strftime('%d.%m.%Y'), f'{start}-{end}'])
+    return rows
+
+
+def generate_building_config(building_number, objects_amount):
+    groups = [{'id': SECTIONS_CHATS_ID_BASE - int(building_number) * 100, 'name': 'admin'},
+              {'id': SECTIONS_CHATS_ID_BASE - int(building_number) * 100 - 1, 'name': 'private_common_group'}]
+    for section in [str(s) for s in range(1, SECTIONS + 1)] + ['p', 's']:
+        groups.append({
+            'id': SECTIONS_CHATS_ID_BASE - int(building_number) * 100 - 10 - len(groups),
+            'name': 'private_section_group',
+            'section': section
+        })
+
+    return {
+        'spreadsheet': {
+            'people': {'id': f'people-{building_number}', 'range': 'Люди!A2:AB'},
+            'parking_cleaning': {'id': f'parking-{building_number}', 'range': 'Уборка!A2:B'},
+            'assistant': {'id': f'assistant-{building_number}', 'range': 'Ассистент!A2:F'},
+        },
+        'objects_amount': {object_type: max(amount, 1)
+                           for object_type, amount in get_objects_amounts(objects_amount).items()},
+        'groups': groups
+    }
+
+
+def generate_buildings(main_module, buildings_amount, objects_amount, seed=34):
+    """
+    Returns fake backend with generated spreadsheets and buildings configs for them
+    """
+    backend = FakeSheetsBackend()
+    configs = {}
+    for i in range(buildings_amount):
+        building_number = str(34 + i)
+        config = generate_building_config(building_number, objects_amount)
+        configs[building_number] = config
+
+        people_rows = generate_people_rows(main_module.DF_COLUMNS, objects_amount, seed + i,
+                                           telegram_id_base=100000000 + i * 10000000)
+        backend.add_spreadsheet(config['spreadsheet']['people']['id'], people_rows)
+        backend.add_spreadsheet(config['spreadsheet']['parking_cleaning']['id'],
+                                generate_parking_cleaning_rows(config['objects_amount']['мм']))
+        backend.add_spreadsheet(config['spreadsheet']['assistant']['id'], [list(row) for row in ASSISTANT_ROWS])
+
+    return backend, configs
+
+
+def install(main_module, generated):
+    """
+    Points main to the fake backend and generated buildings, tables are loaded on the next reload_tables()
+    """
+    backend, configs = generated
+
+    main_module.build = backend.build
+    main_module.GOOGLE_CREDENTIALS = object()
+
+    main_module.CONFIGS['buildings'] = configs
+    main_module.CONFIGS['service'].setdefault('scheduler', {}).setdefault('clean_garbage', {})
+    for building_number in configs:
+        main_module.DB[building_number] = None
+
+    return backend
@@ -0,0 +1,71 @@
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+
+# Posts recorded updates to the bot running in webhook mode, the same way Telegram does.
+#
+# Usage:
+#     python3 post_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret-token <token>
+#
+# Updates are JSON lines with one Update object per line, or a saved getUpdates response.
+
+
+def load_updates(path):
+    with open(path, 'r', encoding='utf8') as f:
+        content = f.read().strip()
+
+    if content.startswith('[') or (content.startswith('{') and '\n' not in content):
+        data = json.loads(content)
+        if isinstance(data, dict):
+            data = data.get('result', [data])
+        return data
+
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def post_update(url, secret_token, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret_token:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret_token)
+
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post recorded updates to the bot webhook')
+    parser.add_argument('updates', help='recorded updates JSON lines file')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/')
+    parser.add_argument('--secret-token')
+    parser.add_argument('--delay', type=float, default=0.0, help='pause between updates, sec')
+    args = parser.parse_args()
+
+    latencies = []
+    statuses = {}
+    for update in load_updates(args.updates):
+        started = time.perf_counter()
+        status = post_update(args.url, args.secret_token, update)
+        latencies.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+        if args.delay:
+            time.sleep(args.delay)
+
+    if not latencies:
+        print('No updates')
+        return
+
+    print('Posted: %s, responses: %s' % (len(latencies), statuses))
+    print('Latency: mean %.2f ms, median %.2f ms, max %.2f ms' % (statistics.mean(latencies) * 1000,
+                                                                 statistics.median(latencies) * 1000,
+                                                                 max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+    main()
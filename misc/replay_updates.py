@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, MessageHandler, SimpleUpdateProcessor, filters
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import fake_sheets  # noqa: E402
+
+# Feeds Telegram updates into the bot Application with all handlers from setup_command_handlers(), Bot API
+# requests are answered locally. Tables are generated by fake_sheets, users contexts are written to a temporary
+# directory.
+#
+# Usage:
+#     python3 replay_updates.py --synthetic 5000
+#     python3 replay_updates.py --updates updates.jsonl --cprofile replay.prof
+#     python3 replay_updates.py --concurrent 64 --api-latency 0.05 --check-counters
+#     python3 replay_updates.py --synthetic 500 --trace traces.jsonl
+#
+# Recorded updates are JSON lines with one Update object per line, or a saved getUpdates response.
+
+BOT_ID = 7000000000
+OBJECTS_AMOUNT = 5000
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Answers Bot API methods with minimal valid objects, optionally after a simulated network latency
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.message_id = 1000000
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        parameters = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({'ok': True, 'result': self.make_result(api_method, parameters)}).encode('utf8')
+
+    def make_result(self, api_method, parameters):
+        if api_method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot', 'username': 'replay_bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': True, 'supports_inline_queries': False}
+
+        if api_method in ('sendMessage', 'forwardMessage', 'editMessageText'):
+            self.message_id += 1
+            chat_id = int(parameters.get('chat_id', 0))
+            return {'message_id': self.message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                    'text': parameters.get('text', '')}
+
+        if api_method == 'copyMessage':
+            self.message_id += 1
+            return {'message_id': self.message_id}
+
+        if api_method == 'getChatMember':
+            return {'status': 'member',
+                    'user': {'id': int(parameters.get('user_id', 0)), 'is_bot': False, 'first_name': 'User'}}
+
+        return True
+
+
+class HandlersTimings:
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+
+    def wrap(self, group, callback):
+        key = (group, getattr(callback, '__name__', repr(callback)))
+        self.durations[key] = []
+        self.errors[key] = 0
+
+        async def timed_callback(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.errors[key] += 1
+                raise
+            finally:
+                self.durations[key].append(time.perf_counter() - started)
+
+        return timed_callback
+
+    def install(self, application):
+        for group, handlers in application.handlers.items():
+            for handler in handlers:
+                handler.callback = self.wrap(group, handler.callback)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def load_updates(path):
+    with open(path, 'r', encoding='utf8') as f:
+        content = f.read().strip()
+
+    if content.startswith('[') or (content.startswith('{') and '\n' not in content):
+        data = json.loads(content)
+        if isinstance(data, dict):
+            data = data.get('result', [data])
+        return data
+
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def generate_updates(amount, seed=34):
+    """
+    Mix of traffic in section chats: plain messages, garbage, commands, assistant requests and private messages
+    """
+    rnd = random.Random(seed)
+    building = next(iter(main.CONFIGS['buildings']))
+    table = main.DB[building]
+    residents = [int(t) for t in table['telegram'].unique() if t]
+    sections_chats = [chat['id'] for chat in main.CONFIGS['buildings'][building]['groups']
+                      if chat['name'] == 'private_section_group']
+
+    texts = ['Добрый день, соседи!', 'Кто-нибудь знает, когда включат отопление?', 'Спасибо!',
+             'Подскажите, пожалуйста, телефон управляющей компании', 'бот, где подключить интернет?']
+    garbage = ['👍', '😂😂😂', '+', 'ааааа', '🔥🔥']
+    commands = ['/neighbours', '/stats', '/help']
+
+    updates = []
+    for update_id in range(1, amount + 1):
+        roll = rnd.random()
+        user_id = rnd.choice(residents) if roll < 0.95 else rnd.randint(1, 99999)
+        chat_id = rnd.choice(sections_chats)
+
+        if roll < 0.05:
+            chat = {'id': user_id, 'type': 'private', 'first_name': 'User'}
+            text = rnd.choice(texts + commands[:1])
+        else:
+            chat = {'id': chat_id, 'type': 'supergroup', 'title': 'Секция'}
+            kind = rnd.random()
+            if kind < 0.15:
+                text = rnd.choice(garbage)
+            elif kind < 0.22:
+                text = rnd.choice(commands)
+            else:
+                text = rnd.choice(texts)
+
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        updates.append({'update_id': update_id, 'message': message})
+
+    return updates
+
+
+class ChatsCounters:
+    """
+    Handler reading per chat state, awaiting and then writing it back, as handlers making Bot API calls while
+    changing state do. Increments are lost when updates of one chat are processed concurrently.
+    """
+
+    def __init__(self):
+        self.counters = {}
+
+    async def count(self, update, context):
+        if update.effective_chat is None:
+            return
+        value = self.counters.get(update.effective_chat.id, 0)
+        await asyncio.sleep(0.001)
+        self.counters[update.effective_chat.id] = value + 1
+
+    def install(self, application):
+        application.add_handler(MessageHandler(filters.ALL, self.count), group=-10)
+
+
+def check_counters(updates, chats_counters):
+    """
+    Every message in a group is counted by stats_collector once, users contexts should have exactly these amounts.
+    Every update is counted by chats_counters once per chat.
+    """
+    expected = {}
+    expected_chats = {}
+    for update in updates:
+        if update.effective_user is not None and update.effective_chat.type != 'private':
+            expected[update.effective_user.id] = expected.get(update.effective_user.id, 0) + 1
+        expected_chats[update.effective_chat.id] = expected_chats.get(update.effective_chat.id, 0) + 1
+
+    main.USERS_CACHE.save_users()
+    main.USERS_CACHE.evict()
+
+    lost = 0
+    for telegram_id, amount in expected.items():
+        if not main.is_resident(telegram_id):
+            continue
+        with open(f'./users/{telegram_id}.json', 'r', encoding='utf8') as f:
+            counted = json.load(f)['stats']['sended_public_messages_total']
+        if counted != amount:
+            lost += amount - counted
+            print(f'User {telegram_id}: sent {amount} messages, counted {counted}')
+
+    chats_lost = 0
+    for chat_id, amount in expected_chats.items():
+        counted = chats_counters.counters.get(chat_id, 0)
+        if counted != amount:
+            chats_lost += amount - counted
+            print(f'Chat {chat_id}: {amount} updates, counted {counted}')
+
+    print(f'\nUsers counters check: {"OK" if lost == 0 else f"{lost} increments lost"}')
+    print(f'Chats counters check: {"OK" if chats_lost == 0 else f"{chats_lost} increments lost"}')
+    return lost == 0 and chats_lost == 0
+
+
+def setup_environment(objects_amount):
+    # users contexts and other data files are written relatively to working directory
+    os.chdir(tempfile.mkdtemp(prefix='replay_'))
+    for directory in ('users', 'data'):
+        os.makedirs(directory, exist_ok=True)
+
+    main.CONFIGS['service'] = {
+        'identity': {'telegram': {'superuser_id': 0}},
+        'scheduler': {
+            'clean_garbage': {'emoji': 300, 'sticker': 300, 'gif': 300},
+            'caches_stale_interval': 3600,
+        },
+    }
+    fake_sheets.install(main, fake_sheets.generate_buildings(main, 1, objects_amount))
+    main.TABLES_RELOADED_TIME = 0
+    main.reload_tables()
+
+    main.GARBAGE_CLASSIFIER = main.GarbageClassifier()
+    main.GARBAGE_CLEANING_CONFIGS = main.build_garbage_cleaning_configs()
+
+    # scheduler is not started, registered jobs only make handlers queue their work as in production
+    main.SCHEDULER.add_job('users_context_save', main.proceed_users_context_save, interval=3600)
+    main.SCHEDULER.add_job('actions_queue', main.proceed_actions_queue)
+    main.SCHEDULER.add_job('tables_write_back', main.TABLES_WRITE_BACK.flush)
+
+
+async def replay(args):
+    setup_environment(args.objects)
+    if args.trace:
+        main.TRACER.configure(True, args.trace, 0, 0)
+    updates_data = load_updates(args.updates) if args.updates else generate_updates(args.synthetic)
+
+    main.TG_RATE_LIMITER = main.TelegramRateLimiter(chat_rate=1, global_rate=30, max_retries=3)
+
+    telegram_request = FakeTelegramRequest(args.api_latency)
+    builder = ApplicationBuilder()
+    builder.token(f'{BOT_ID}:replay')
+    builder.request(telegram_request)
+    builder.get_updates_request(FakeTelegramRequest())
+    if args.rate_limiter:
+        builder.rate_limiter(main.TG_RATE_LIMITER)
+    main.TG_UPDATE_PROCESSOR = main.OrderedUpdateProcessor(max(args.concurrent, 1))
+    if args.concurrent and args.unordered:
+        builder.concurrent_updates(SimpleUpdateProcessor(args.concurrent))
+    elif args.concurrent or args.trace:
+        # root spans of updates are opened by the bot update processor
+        builder.concurrent_updates(main.TG_UPDATE_PROCESSOR)
+    application = builder.build()
+
+    main.TG_BOT_APPLICATION = application
+    main.TG_BOT = application.bot
+    main.setup_command_handlers(application)
+
+    timings = HandlersTimings()
+    chats_counters = ChatsCounters()
+    if args.check_counters:
+        chats_counters.install(application)
+
+    timings.install(application)
+
+    await application.initialize()
+
+    profiler = None
+    instrument_profiler = None
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.pyinstrument:
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print('pyinstrument is not installed, skipping')
+        else:
+            instrument_profiler = Profiler(async_mode='enabled')
+            instrument_profiler.start()
+
+    latencies = []
+
+    async def process_update(update):
+        update_started = time.perf_counter()
+        # same path as updates fetched by Updater go in Application
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - update_started)
+
+    updates = [Update.de_json(update_data, application.bot) for update_data in updates_data]
+    started = time.perf_counter()
+    if args.concurrent:
+        await asyncio.gather(*[process_update(update) for update in updates])
+    else:
+        for update in updates:
+            await process_update(update)
+    elapsed = time.perf_counter() - started
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.abspath(args.cprofile))
+    if instrument_profiler is not None:
+        instrument_profiler.stop()
+        with open(args.pyinstrument, 'w', encoding='utf8') as f:
+            f.write(instrument_profiler.output_html())
+
+    await application.shutdown()
+
+    print(f'Updates: {len(latencies)}, total {elapsed:.3f} sec, {len(latencies) / elapsed:.1f} updates/sec')
+    print(f'Latency: p50 {percentile(latencies, 50) * 1000:.2f} ms, p95 {percentile(latencies, 95) * 1000:.2f} ms, '
+          f'p99 {percentile(latencies, 99) * 1000:.2f} ms, max {max(latencies, default=0) * 1000:.2f} ms')
+
+    print('\nHandlers:')
+    groups_totals = {}
+    for (group, name), durations in sorted(timings.durations.items()):
+        groups_totals[group] = groups_totals.get(group, 0) + sum(durations)
+        if not durations:
+            continue
+        print(f'  [{group}] {name}: calls {len(durations)}, errors {timings.errors[(group, name)]}, '
+              f'mean {statistics.mean(durations) * 1000:.2f} ms, p99 {percentile(durations, 99) * 1000:.2f} ms, '
+              f'total {sum(durations):.3f} sec')
+
+    print('\nGroups:')
+    for group, total in sorted(groups_totals.items()):
+        print(f'  [{group}]: total {total:.3f} sec, {total / max(len(latencies), 1) * 1000:.2f} ms per update')
+
+    print(f'\nBot API calls: {telegram_request.calls}')
+
+    if args.check_counters and not check_counters(updates, chats_counters):
+        sys.exit(1)
+
+    if profiler is not None:
+        print()
+        pstats.Stats(os.path.abspath(args.cprofile)).sort_stats('cumulative').print_stats(25)
+
+
+def main_replay():
+    parser = argparse.ArgumentParser(description='Replay of Telegram updates through bot handlers')
+    parser.add_argument('--updates', help='recorded updates JSON lines file')
+    parser.add_argument('--synthetic', type=int, default=1000, help='amount of generated updates')
+    parser.add_argument('--objects', type=int, default=OBJECTS_AMOUNT, help='objects in generated building')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated Bot API latency, sec')
+    parser.add_argument('--concurrent', type=int, default=0,
+                        help='process updates concurrently with up to N at once, as the bot does')
+    parser.add_argument('--unordered', action='store_true',
+                        help='use plain concurrent processing without per user and per chat ordering')
+    parser.add_argument('--check-counters', action='store_true',
+                        help='fail if users messages counters do not match replayed messages')
+    parser.add_argument('--rate-limiter', action='store_true', help='send Bot API requests through rate limiter')
+    parser.add_argument('--cprofile', help='save cProfile stats to file')
+    parser.add_argument('--pyinstrument', help='save pyinstrument HTML report to file')
+    parser.add_argument('--trace', help='write tracing spans to JSON lines file, see trace_to_chrome.py')
+    args = parser.parse_args()
+
+    if args.updates:
+        args.updates = os.path.abspath(args.updates)
+    for option in ('cprofile', 'pyinstrument', 'trace'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main_replay()
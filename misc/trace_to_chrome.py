@@ -0,0 +1,97 @@
+import argparse
+import glob
+import json
+import os
+
+# Converts tracing spans written by the bot (service.tracing in configs/service.json) to Chrome trace format,
+# the result is opened in chrome://tracing or https://ui.perfetto.dev.
+#
+# Usage:
+#     python3 trace_to_chrome.py ../data/traces.jsonl --output traces.json
+#     python3 trace_to_chrome.py ../data/traces.jsonl --slower 500 --top 20
+#
+# Rotated files (traces.jsonl.1, traces.jsonl.2, ...) are read too.
+
+
+def load_spans(path):
+    paths = sorted(glob.glob(glob.escape(path) + '.*'), reverse=True)
+    if os.path.exists(path):
+        paths.append(path)
+
+    spans = []
+    for span_path in paths:
+        with open(span_path, 'r', encoding='utf8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    spans.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may be cut when the bot is killed while writing
+                    continue
+    return spans
+
+
+def get_root_spans(spans):
+    return [span for span in spans if span['cat'] == 'update']
+
+
+def filter_slow_traces(spans, slower_ms):
+    slow_traces = {span['tid'] for span in get_root_spans(spans)
+                   if span['name'] == 'update' and span['dur'] >= slower_ms * 1000}
+    return [span for span in spans if span['tid'] in slow_traces]
+
+
+def print_summary(spans, top):
+    updates = sorted((span for span in get_root_spans(spans) if span['name'] == 'update'),
+                     key=lambda span: span['dur'], reverse=True)
+    print(f'Spans: {len(spans)}, updates: {len(updates)}')
+
+    children = {}
+    for span in spans:
+        children.setdefault(span['tid'], []).append(span)
+
+    for update in updates[:top]:
+        args = update.get('args', {})
+        title = args.get('command') or args.get('callback_data') or ''
+        print(f'\n{update["dur"] / 1000:.2f} ms  update {args.get("update_id")} {title}'
+              f'  chat {args.get("chat")} user {args.get("user")}')
+        for span in sorted(children[update['tid']], key=lambda s: s['ts']):
+            if span is update:
+                continue
+            print(f'  {span["dur"] / 1000:9.2f} ms  [{span["cat"]}] {span["name"]}')
+
+    totals = {}
+    for span in spans:
+        key = (span['cat'], span['name'])
+        calls, duration = totals.get(key, (0, 0))
+        totals[key] = (calls + 1, duration + span['dur'])
+    print('\nTotal by span:')
+    for (category, name), (calls, duration) in sorted(totals.items(), key=lambda x: x[1][1], reverse=True)[:top]:
+        print(f'  [{category}] {name}: calls {calls}, total {duration / 1000:.2f} ms, '
+              f'mean {duration / calls / 1000:.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert bot tracing spans to Chrome trace format')
+    parser.add_argument('spans', help='spans JSON lines file')
+    parser.add_argument('--output', help='Chrome trace JSON file')
+    parser.add_argument('--slower', type=float, default=0, help='keep only updates slower than this, ms')
+    parser.add_argument('--top', type=int, default=10, help='amount of the slowest updates in summary')
+    args = parser.parse_args()
+
+    spans = load_spans(args.spans)
+    if args.slower:
+        spans = filter_slow_traces(spans, args.slower)
+
+    print_summary(spans, args.top)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump({'traceEvents': spans, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        print(f'\nSaved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()